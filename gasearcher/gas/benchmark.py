@@ -0,0 +1,205 @@
+import argparse
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+import zlib
+
+import numpy as np
+
+from gas.classes import ClassTable, write_class_matrix
+from gas.data import LoaderDatabase
+from gas.embeddings import write_packed
+from gas.logger import Logger, LogWriter
+from gas.searcher import Searcher
+from gas.settings import SHOWING
+
+SIZES = (10000, 100000, 1000000)  # default numbers of frames of synthetic datasets
+
+
+class StubEncoder:
+    """
+    Encoder of text queries which returns random normalized vectors (the same vector for the same query),
+    so benchmarks do not depend on the CLIP model.
+
+    Attributes:
+        dim (int): The dimension of feature vectors.
+    """
+
+    def __init__(self, dim=512):
+        """
+        Args:
+            dim (int): The dimension of feature vectors.
+        """
+        self.dim = dim
+
+    def encode(self, queries):
+        """
+        Encodes the queries.
+
+        Args:
+            queries (list): A list of text queries.
+
+        Returns:
+            numpy.ndarray: A 2D float32 matrix of normalized feature vectors (one row per query).
+        """
+        vectors = np.stack([np.random.default_rng(zlib.crc32(query.encode())).standard_normal(self.dim)
+                            for query in queries]).astype(np.float32)
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def synthetic_dataset(size, dim=512, top_k=10, n_classes=7000, video_length=500, seed=0):
+    """
+    Generates a synthetic dataset.
+
+    Args:
+        size (int): The number of frames.
+        dim (int): The dimension of feature vectors.
+        top_k (int): The number of classes of each frame.
+        n_classes (int): The number of classes.
+        video_length (int): The number of frames of each video.
+        seed (int): The seed of random generator.
+
+    Returns:
+        tuple: The matrix of normalized feature vectors, the matrix of classes of frames and the index of video
+            of each frame.
+    """
+    rng = np.random.default_rng(seed)
+    clip_data = np.empty((size, dim), dtype=np.float32)
+    for start in range(0, size, 65536):
+        chunk = rng.standard_normal((min(65536, size - start), dim), dtype=np.float32)
+        clip_data[start:start + len(chunk)] = chunk / np.linalg.norm(chunk, axis=1, keepdims=True)
+    class_data = rng.integers(0, n_classes, (size, top_k), dtype=np.int16)
+    video_ids = np.arange(size) // video_length
+    return clip_data, class_data, video_ids
+
+
+def measure(function, repeat):
+    """
+    Measures latency, throughput and peak of memory allocated by the function. Memory is traced in a separate pass,
+    because tracing slows down every allocation and would inflate the latency.
+
+    Args:
+        function (function): The measured function (called with the number of the call).
+        repeat (int): The number of calls.
+
+    Returns:
+        dict: The median, 95th percentile and mean latency (in milliseconds), throughput (calls per second)
+            and peak of allocated memory (in megabytes).
+    """
+    function(0)  # warm up
+
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function(i)
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    for i in range(repeat):
+        function(i)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    times = np.asarray(times) * 1000
+    return {'p50_ms': round(float(np.percentile(times, 50)), 3), 'p95_ms': round(float(np.percentile(times, 95)), 3),
+            'mean_ms': round(float(times.mean()), 3), 'throughput_qps': round(1000 * repeat / float(times.sum()), 2),
+            'peak_memory_mb': round(peak / 2 ** 20, 2)}
+
+
+def benchmark_loader(clip_data, class_data, video_ids, repeat):
+    """
+    Measures loading of the dataset by LoaderDatabase (packed CLIP data, class table and ends of videos).
+
+    Args:
+        clip_data (numpy.ndarray): The matrix of normalized feature vectors.
+        class_data (numpy.ndarray): The matrix of classes of frames.
+        video_ids (numpy.ndarray): The index of video of each frame.
+        repeat (int): The number of loads.
+
+    Returns:
+        dict: The measured values.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        loader = LoaderDatabase(directory + "/")
+        write_packed(loader.path_clip_packed, clip_data)
+        write_class_matrix(loader.path_classes_matrix, class_data)
+        # first frame of each video (numbered from 1)
+        np.savetxt(loader.path_ends, np.concatenate([[1], np.flatnonzero(np.diff(video_ids)) + 2]), fmt="%d")
+
+        def load(_):
+            matrix = loader.get_photos_classes()
+            np.asarray(loader.get_clip_data()).sum()  # touch all pages of mapped file
+            loader.get_video_ids(len(matrix))
+
+        return measure(load, repeat)
+
+
+def run(sizes=SIZES, repeat=20, seed=0):
+    """
+    Runs all benchmarks for synthetic datasets of given sizes.
+
+    Args:
+        sizes (list): The numbers of frames of synthetic datasets.
+        repeat (int): The number of measured calls of each benchmark.
+        seed (int): The seed of random generator.
+
+    Returns:
+        dict: The description of environment and the measured values of each benchmark and size.
+    """
+    results = []
+    for size in sizes:
+        clip_data, class_data, video_ids = synthetic_dataset(size, seed=seed)
+        rng = np.random.default_rng(seed)
+        targets = rng.integers(0, size, 100).tolist()
+        queries = [f"query {i}" for i in range(repeat + 1)]
+
+        with tempfile.TemporaryDirectory() as directory:
+            writer = LogWriter()
+            logger = Logger(directory + "/", {}, targets, False, writer)
+            searcher = Searcher(clip_data, False, logger, SHOWING, video_ids=video_ids, encoder=StubEncoder())
+            query_vectors = StubEncoder().encode(queries)
+            class_table = ClassTable.from_matrix(class_data)
+            shown = searcher.text_search(queries[0], "benchmark", 0, "")
+            searcher.set_last_sent("benchmark", shown)
+            liked = [f"{shown[1]}_{shown[2]}" for _ in range(repeat + 1)]
+
+            benchmarks = {
+                'result_score': lambda i: searcher.result_score(query_vectors[i]),
+                'text_search': lambda i: searcher.text_search(queries[i], f"session {i}", i % len(targets), ""),
+                'temporal_search': lambda i: searcher.temporal_search(f"{queries[i]}>{queries[-1 - i]}",
+                                                                      f"session {i}", i % len(targets)),
+                'image_search': lambda i: searcher.image_search(targets[i % len(targets)], i % len(targets),
+                                                                f"session {i}"),
+                'bayes_update': lambda i: searcher.bayes_update(liked[i], i % len(targets), "benchmark"),
+                'top_classes': lambda i: class_table.top_classes(shown),
+            }
+            for name, function in benchmarks.items():
+                results.append({'size': size, 'benchmark': name, **measure(function, repeat)})
+            writer.close()
+
+        results.append({'size': size, 'benchmark': 'loader',
+                        **benchmark_loader(clip_data, class_data, video_ids, max(1, repeat // 10))})
+
+    return {'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                            'machine': platform.machine(), 'cpus': os.cpu_count()},
+            'repeat': repeat, 'seed': seed, 'results': results}
+
+
+if __name__ == "__main__":
+    # usage: python -m gas.benchmark [--sizes 10000 100000 1000000] [--repeat 20] [--output results.json]
+    parser = argparse.ArgumentParser(description="Benchmark of searching in synthetic datasets.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="numbers of frames of datasets")
+    parser.add_argument("--repeat", type=int, default=20, help="number of measured calls of each benchmark")
+    parser.add_argument("--seed", type=int, default=0, help="seed of random generator")
+    parser.add_argument("--output", help="file where the results are saved as JSON (printed if it is not given)")
+    args = parser.parse_args()
+
+    report = json.dumps(run(args.sizes, args.repeat, args.seed), indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+    else:
+        print(report)
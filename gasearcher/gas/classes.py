@@ -0,0 +1,168 @@
+import sys
+
+import numpy as np
+
+from gas.files import atomic_write
+
+
+class ClassTable:
+    """
+    Array-backed (CSR-style) table of classes of images, built once at load time, so classes of shown images and
+    the top classes of the result are computed without per-image dictionary lookups.
+
+    Attributes:
+        indptr (numpy.ndarray): The start of classes of each image in indices (the last value is the end).
+        indices (numpy.ndarray): The indexes of classes ordered by images.
+        n_classes (int): The number of classes.
+    """
+
+    def __init__(self, indptr, indices, n_classes=None):
+        """
+        Args:
+            indptr (numpy.ndarray): The start of classes of each image in indices (the last value is the end).
+            indices (numpy.ndarray): The indexes of classes ordered by images.
+            n_classes (int): The number of classes (by default the highest class index + 1).
+        """
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.n_classes = n_classes if n_classes is not None else int(self.indices.max(initial=-1)) + 1
+
+    @classmethod
+    def from_matrix(cls, matrix, n_classes=None):
+        """
+        Builds the table from the matrix of top classes of images (padded by -1).
+
+        Args:
+            matrix (numpy.ndarray): A 2D matrix with indexes of classes of each image (one row per image).
+            n_classes (int): The number of classes.
+
+        Returns:
+            ClassTable: The built table.
+        """
+        valid = matrix >= 0
+        indptr = np.concatenate([[0], np.cumsum(valid.sum(axis=1))])
+        return cls(indptr, matrix[valid], n_classes)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def gather(self, ids):
+        """
+        Gets classes of all given images at once.
+
+        Args:
+            ids (list): The indexes of images (indexes out of the dataset have no classes).
+
+        Returns:
+            tuple: The indexes of classes of all images concatenated and the number of classes of each image.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        valid = (ids >= 0) & (ids < len(self))
+        starts = self.indptr[np.where(valid, ids, 0)]
+        counts = np.where(valid, self.indptr[np.where(valid, ids, 0) + 1] - starts, 0)
+
+        # position of each class = start of its image + offset within the image
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return self.indices[np.repeat(starts, counts) + offsets], counts
+
+    def classes_of(self, ids):
+        """
+        Gets classes of each given image.
+
+        Args:
+            ids (list): The indexes of images.
+
+        Returns:
+            list: A list of indexes of classes for each image.
+        """
+        values, counts = self.gather(ids)
+        return [part.tolist() for part in np.split(values, np.cumsum(counts)[:-1])] if len(counts) else []
+
+    def top_classes(self, ids, k=5, min_count=5):
+        """
+        Finds the most frequent classes of the given images.
+
+        Args:
+            ids (list): The indexes of images.
+            k (int): The maximal number of returned classes.
+            min_count (int): Only classes with more occurrences are returned.
+
+        Returns:
+            list: The indexes of the most frequent classes (the most frequent first).
+        """
+        values, _ = self.gather(ids)
+        counts = np.bincount(values, minlength=self.n_classes)
+        top = np.argsort(-counts, kind="stable")[:k]
+        return top[counts[top] > min_count].tolist()
+
+
+def class_matrix(ids, top, size_dataset=None):
+    """
+    Creates the matrix of top classes of images (rows are ordered by images, missing values are -1).
+
+    Args:
+        ids (list): The ids of images (the names of frames numbered from 1).
+        top (list): The lists of indexes of top classes of each image.
+        size_dataset (int): The total number of images (by default the highest id).
+
+    Returns:
+        numpy.ndarray: A 2D int16 matrix (int32 if there are too many classes) of indexes of classes.
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    top_k = max((len(values) for values in top), default=0)
+    highest = max((max(values) for values in top if len(values)), default=0)
+    size_dataset = int(ids.max(initial=0)) if size_dataset is None else size_dataset
+
+    matrix = np.full((size_dataset, top_k), -1, dtype=np.int16 if highest < 2 ** 15 else np.int32)
+    for i, values in zip(ids - 1, top):
+        matrix[i, :len(values)] = values
+    return matrix
+
+
+def write_class_matrix(path, matrix):
+    """
+    Writes the matrix of top classes of images to the binary file (the file is replaced atomically).
+
+    Args:
+        path (str): The path of the file (.npy).
+        matrix (numpy.ndarray): The matrix of top classes of images.
+    """
+    with atomic_write(path) as f:
+        np.save(f, matrix, allow_pickle=False)
+
+
+def read_class_matrix(path):
+    """
+    Reads the matrix of top classes of images from the binary file (in one read).
+
+    Args:
+        path (str): The path of the file (.npy).
+
+    Returns:
+        numpy.ndarray: The matrix of top classes of images.
+    """
+    return np.load(path, allow_pickle=False)
+
+
+def convert_classes_csv(csv_path, output_file):
+    """
+    Converts the CSV file with classification of images (id;[classes]) to the binary file.
+
+    Args:
+        csv_path (str): The path to the CSV file.
+        output_file (str): The path of the created binary file.
+    """
+    ids, top = [], []
+    with open(csv_path) as f:
+        next(f)  # header
+        for line in f:
+            if line.strip():
+                image_id, values = line.split(";")
+                ids.append(int(image_id))
+                top.append([int(value) for value in values.strip()[1:-1].split(",") if value.strip()])
+    write_class_matrix(output_file, class_matrix(ids, top))
+
+
+if __name__ == "__main__":
+    # usage: python -m gas.classes <csv file> <binary file>
+    convert_classes_csv(sys.argv[1], sys.argv[2])
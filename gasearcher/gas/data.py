@@ -1,14 +1,19 @@
+import hashlib
 import os
 import random
-from ast import literal_eval
 
 import numpy as np
-import pandas as pd
 import torch as torch
 from sklearn_som.som import SOM
 
-from gas.settings import PATH_CLIP, PATH_NOUNLIST, PATH_CLASSES, PATH_SELECTION, PATH_ENDS, IMAGES_ON_LINE, \
-    LINES, NUMBER_OF_SEARCHED, USING_SOM, SHOWING
+from gas.classes import convert_classes_csv, read_class_matrix
+from gas.embeddings import convert_clip_folder, read_packed
+from gas.files import atomic_write
+from gas.index import IVFIndex
+from gas.quantization import QuantizedEmbeddings
+from gas.settings import PATH_CLIP, PATH_CLIP_PACKED, PATH_INDEX, PATH_TEXT_CACHE, PATH_SESSIONS, PATH_NOUNLIST, \
+    PATH_CLASSES, PATH_CLASSES_MATRIX, PATH_SOM, PATH_SELECTION, PATH_ENDS, IMAGES_ON_LINE, LINES, \
+    NUMBER_OF_SEARCHED, USING_SOM, SHOWING, INDEX_PROBE
 
 
 class LoaderDatabase:
@@ -19,8 +24,15 @@ class LoaderDatabase:
         path_data (str): The path to the database.
         is_sea_database (bool): A boolean representing whether the database is a sea database or not.
         path_clip (str): The path to folder with preprocessed CLIP data.
+        path_clip_packed (str): The path to the packed file with preprocessed CLIP data.
+        path_index (str): The path to the file with approximate nearest-neighbour index.
+        path_text_cache (str): The path to the file with persisted cache of text queries.
+        path_sessions (str): The path to the database with states of sessions shared by server processes.
         path_nounlist (str): The path to the nounlist.
         path_classes (str): The path to the file with classification of images.
+        path_classes_matrix (str): The path to the binary file with classification of images (created from
+            path_classes if it does not exist).
+        path_som (str): The path to the file with cached SOM of class labels and first screens.
         path_selection (str): The path to the file with indexes of images which should be used for searching.
         path_ends (str): The path to the file with indexes of images which represents ends of each video.
     """
@@ -32,40 +44,118 @@ class LoaderDatabase:
             is_sea_database (bool): A boolean representing whether the database is a sea database or not.
         """
         self.path_clip = path_data + ("sea_clip" if is_sea_database else PATH_CLIP)
+        self.path_clip_packed = path_data + ("sea_clip.bin" if is_sea_database else PATH_CLIP_PACKED)
+        self.path_index = path_data + ("sea_clip_index.npz" if is_sea_database else PATH_INDEX)
+        self.path_text_cache = path_data + ("sea_text_cache.npz" if is_sea_database else PATH_TEXT_CACHE)
+        self.path_sessions = path_data + ("sea_sessions.sqlite3" if is_sea_database else PATH_SESSIONS)
         self.path_nounlist = path_data + ("sea_nounlist.txt" if is_sea_database else PATH_NOUNLIST)
         self.path_classes = path_data + ("sea_result.csv" if is_sea_database else PATH_CLASSES)
+        self.path_classes_matrix = path_data + ("sea_result.npy" if is_sea_database else PATH_CLASSES_MATRIX)
+        self.path_som = path_data + ("sea_som.npz" if is_sea_database else PATH_SOM)
         self.path_selection = path_data + ("" if is_sea_database else PATH_SELECTION)
         self.path_ends = path_data + ("videos.txt" if is_sea_database else PATH_ENDS)
         self.is_sea_database = is_sea_database
         self.path_data = path_data
 
-    def get_clip_data(self):
+    def get_clip_data(self, shared=False):
         """
-        Loads the preprocessed data from CLIP.
+        Loads the preprocessed data from CLIP. The packed file is mapped to memory if exists (without copy for float32),
+        otherwise the folder with one file per image is loaded.
+
+        Args:
+            shared (bool): Whether the data should be shared by all server processes (the packed file is created
+                from the folder if it does not exist, so all processes map the same memory).
 
         Returns:
-            list: A list of preprocessed data from CLIP.
+            numpy.ndarray: A contiguous float32 matrix of normalized CLIP features (one row per image).
 
         """
         print('loading data...')
+        if shared and not os.path.exists(self.path_clip_packed):
+            convert_clip_folder(self.path_clip, self.path_clip_packed)
+        if os.path.exists(self.path_clip_packed):
+            clip_data, ids = read_packed(self.path_clip_packed)
+            # row i is used as the image i + 1 (photos, classes and targets), so the ids have to be consecutive
+            mismatch = np.flatnonzero(ids != np.arange(1, len(ids) + 1))
+            if len(mismatch):
+                raise ValueError(f"{self.path_clip_packed} contains image {ids[mismatch[0]]} in row {mismatch[0]}, "
+                                 f"ids of images have to be consecutive from 1.")
+            return clip_data if clip_data.dtype == np.float32 else clip_data.astype(np.float32)
+
         clip_data = []
 
         # preprocessed data from clip
         for fn in sorted(os.listdir(self.path_clip)):
-            clip_data.append(torch.load(self.path_clip + f"/{fn}"))
-        return clip_data
+            clip_data.append(torch.load(self.path_clip + f"/{fn}", map_location="cpu"))
+
+        # stack only once at startup (searching then works directly on this matrix)
+        clip_data = torch.cat(clip_data).float().numpy()
+        clip_data /= np.linalg.norm(clip_data, axis=1, keepdims=True)
+        return np.ascontiguousarray(clip_data)
+
+    def get_quantized_data(self, precision, shared=False):
+        """
+        Loads the preprocessed data from CLIP with reduced precision. The float32 vectors are kept (for exact
+        re-scoring and image queries) only if they are mapped from the packed file, so they do not use private memory.
+
+        Args:
+            precision (str): The precision of stored vectors ("float32", "float16" or "int8").
+            shared (bool): Whether the data should be shared by all server processes.
+
+        Returns:
+            tuple: The float32 matrix of CLIP features (None if it is not kept) and the quantized features
+                (None for float32 precision).
+        """
+        clip_data = self.get_clip_data(shared)
+        if precision == "float32":
+            return clip_data, None
+        quantized = QuantizedEmbeddings.quantize(clip_data, precision)
+        return (clip_data if isinstance(clip_data, np.memmap) else None), quantized
+
+    def get_snapshot_time(self):
+        """
+        Gets the time of the last change of the packed file with CLIP data (it is replaced when new videos
+        are ingested).
+
+        Returns:
+            int: The time of modification in nanoseconds (None if the packed file does not exist).
+        """
+        if not os.path.exists(self.path_clip_packed):
+            return None
+        return os.stat(self.path_clip_packed).st_mtime_ns
+
+    def get_index(self, size_dataset=None):
+        """
+        Loads the approximate nearest-neighbour index built offline (by `python -m gas.index`).
+
+        Args:
+            size_dataset (int): The total number of images in the dataset (the index is not used if it does not
+                contain all images, e.g. after new videos were ingested).
+
+        Returns:
+            IVFIndex: The loaded index or None if the index was not built.
+        """
+        if not os.path.exists(self.path_index):
+            print('index not found, exact search is used')
+            return None
+        index = IVFIndex.load(self.path_index, INDEX_PROBE)
+        if size_dataset is not None and len(index.list_ids) != size_dataset:
+            print('index does not contain all images, exact search is used')
+            return None
+        return index
 
     def get_photos_classes(self):
         """
-        Loads the photo classes.
+        Loads the photo classes (the binary file is created from the CSV file at the first run).
 
         Returns:
-            dict: A dictionary where keys are integers representing image indexes
-            and values are lists of indexes representing classes.
+            numpy.ndarray: A 2D matrix where rows are images (by their indexes) and values are indexes
+            of top classes (missing values are -1).
 
         """
-        class_data = pd.read_csv(self.path_classes, sep=';').set_index('id').to_dict()['top']
-        return {int(key) - 1: literal_eval(value) for key, value in class_data.items()}
+        if not os.path.exists(self.path_classes_matrix):
+            convert_classes_csv(self.path_classes, self.path_classes_matrix)
+        return read_class_matrix(self.path_classes_matrix)
 
     def get_classes(self):
         """
@@ -113,6 +203,23 @@ class LoaderDatabase:
 
         return same_video
 
+    def get_video_ids(self, size_dataset):
+        """
+        Load index of video of each image from dataset.
+
+        Args:
+            size_dataset (int): The total number of images in the dataset.
+
+        Returns:
+            numpy.ndarray: A 1D array with index of video of each image (all images are from one video if ends
+                of videos are not defined).
+        """
+        starts = [0]
+        if os.path.exists(self.path_ends):
+            with open(self.path_ends, 'r') as f:
+                starts = [int(line) - 1 for line in f if line.strip()]
+        return np.searchsorted(starts, np.arange(size_dataset), side='right') - 1
+
     def set_finding(self, size_dataset):
         """
         Generate indexes of images that should be found.
@@ -137,41 +244,61 @@ class LoaderDatabase:
 
         return targets
 
-    @staticmethod
-    def load_first_screen(class_data, size_dataset, targets):
+    def load_first_screen(self, class_data, size_dataset, targets, n_screens=1):
         """
-        Generate the initial set of images indexes using SOM of class labels.
+        Generate the initial sets of images indexes using SOM of class labels. The trained SOM and the screens are
+        cached in the file (keyed by hash of class data), so SOM is trained only when the class data change.
 
         Args:
-            class_data (dict): A dictionary containing the class labels for each image. (used by SOM)
+            class_data (numpy.ndarray): A matrix containing the class labels for each image. (used by SOM)
             size_dataset (int): The size of the dataset.
             targets (list): A list of indexes of images that should be found.
+            n_screens (int): The number of randomized first screens (rotated between sessions).
 
         Returns:
-            list: A list of indexes of images representing the first window.
+            list: A list of first screens, each of them is a list of indexes of images representing the first window.
         """
-        first_show = [random.randint(1, size_dataset - 1) for _ in range(SHOWING)]
+        if not USING_SOM:
+            return [[random.randint(1, size_dataset - 1) for _ in range(SHOWING)] for _ in range(n_screens)]
+
+        key = hashlib.sha1(class_data.tobytes() + repr((class_data.shape, 4, IMAGES_ON_LINE)).encode()).hexdigest()
+        if os.path.exists(self.path_som):
+            with np.load(self.path_som) as f:
+                if str(f['key']) == key:
+                    prediction, screens = f['prediction'], f['screens']
+                    if len(screens) >= n_screens:
+                        return screens[:n_screens].tolist()
+                    # more screens are needed, but SOM is not trained again
+                    return self._save_som(key, f['weights'], prediction, screens, n_screens, size_dataset, targets)
+
+        # get first window - SOM of labels
+        print('training SOM...')
+        input_data = class_data.astype(np.float64)
+        som = SOM(m=4, n=IMAGES_ON_LINE, dim=len(input_data[0]))
+        prediction = som.fit_predict(input_data)
+
+        return self._save_som(key, som.cluster_centers_, prediction, np.empty((0, 4 * IMAGES_ON_LINE), dtype=np.int64),
+                              n_screens, size_dataset, targets)
+
+    def _save_som(self, key, weights, prediction, screens, n_screens, size_dataset, targets):
+        # generate missing screens and cache them with SOM
+        screens = np.concatenate([screens] + [[self._pick_screen(prediction, size_dataset, targets)]
+                                              for _ in range(n_screens - len(screens))]).astype(np.int64)
+        with atomic_write(self.path_som) as f:
+            np.savez(f, key=key, weights=weights, prediction=prediction, screens=screens)
+        return screens[:n_screens].tolist()
 
-        if USING_SOM:
-            first_show = [0 for _ in range(4 * IMAGES_ON_LINE)]
-            # get first window - SOM of labels
-            input_data = np.array(list(class_data.values()))
-            som = SOM(m=4, n=IMAGES_ON_LINE, dim=len(input_data[0]))
-
-            prediction = som.fit_predict(input_data)
-
-            for i in range(len(first_show)):
-                if i in prediction:
-                    first_show[i] = np.random.choice(np.where(prediction == i)[0])
-                else:
-                    first_show[i] = -1
-
-            for i in range(len(first_show)):
-                if first_show[i] == -1 and len((set(first_show) & set(targets)) - {-1}) < size_dataset:
-                    print("here")
+    @staticmethod
+    def _pick_screen(prediction, size_dataset, targets):
+        # one random representative of each SOM cell (random image for empty cells)
+        first_show = [np.random.choice(np.where(prediction == i)[0]) if i in prediction else -1
+                      for i in range(4 * IMAGES_ON_LINE)]
+
+        for i in range(len(first_show)):
+            if first_show[i] == -1 and len((set(first_show) & set(targets)) - {-1}) < size_dataset:
+                next_id = random.randint(1, size_dataset - 1)
+                while next_id in first_show:
                     next_id = random.randint(1, size_dataset - 1)
-                    while next_id in first_show:
-                        next_id = random.randint(1, size_dataset - 1)
-                    first_show[i] = next_id
+                first_show[i] = next_id
 
         return first_show
@@ -0,0 +1,113 @@
+import os
+import struct
+import sys
+
+import numpy as np
+
+from gas.files import atomic_write
+
+# layout of packed file: header | matrix of features (rows x dim) | table of image ids (rows)
+MAGIC = b"GASCLIP\x00"
+VERSION = 1
+HEADER = struct.Struct("<8sIIQQQQ")  # magic, version, dtype, rows, dim, offset of matrix, offset of ids
+HEADER_SIZE = 64  # matrix starts aligned after the header
+DTYPES = {0: np.dtype(np.float32), 1: np.dtype(np.float16)}
+CHUNK = 65536  # rows copied at once when vectors are appended
+
+
+def write_packed(path, vectors, ids=None, dtype=np.float32):
+    """
+    Writes feature vectors to a single packed file (the file is replaced atomically).
+
+    Args:
+        path (str): The path of the packed file.
+        vectors (numpy.ndarray): A 2D matrix of normalized feature vectors (one row per image).
+        ids (numpy.ndarray): The ids of images (the names of frames), by default numbered from 1.
+        dtype: The type used for storing of the vectors (float32 or float16).
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=dtype)
+    ids = np.arange(1, len(vectors) + 1) if ids is None else ids
+    _write(path, vectors.dtype, vectors.shape, [vectors], [np.ascontiguousarray(ids, dtype=np.int64)])
+
+
+def append_packed(path, vectors, ids, output_path=None):
+    """
+    Writes a new snapshot of the packed file with appended feature vectors. The previous vectors are copied
+    in chunks (the whole matrix is never loaded) and the file is replaced atomically, so processes which mapped
+    the previous snapshot keep reading it until they load the new one.
+
+    Args:
+        path (str): The path of the packed file.
+        vectors (numpy.ndarray): A 2D matrix of appended normalized feature vectors.
+        ids (numpy.ndarray): The ids of appended images.
+        output_path (str): The path of the new snapshot (by default the packed file is replaced), so the snapshot
+            can be staged and moved to the packed file later.
+    """
+    old_vectors, old_ids = read_packed(path)
+    vectors = np.ascontiguousarray(vectors, dtype=old_vectors.dtype)
+    chunks = (old_vectors[start:start + CHUNK] for start in range(0, len(old_vectors), CHUNK))
+    shape = (len(old_vectors) + len(vectors), old_vectors.shape[1])
+    _write(output_path or path, old_vectors.dtype, shape, [*chunks, vectors],
+           [old_ids, np.ascontiguousarray(ids, dtype=np.int64)])
+
+
+def read_packed(path):
+    """
+    Maps the packed file to memory (zero-copy, the pages are shared by all processes reading the same file).
+
+    Args:
+        path (str): The path of the packed file.
+
+    Returns:
+        tuple: A read-only matrix of feature vectors and a table with ids of images.
+    """
+    with open(path, "rb") as f:
+        magic, version, code, rows, dim, offset, ids_offset = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{path} is not a packed file with CLIP data.")
+
+    vectors = np.memmap(path, dtype=DTYPES[code], mode="r", offset=offset, shape=(rows, dim))
+    ids = np.memmap(path, dtype=np.int64, mode="r", offset=ids_offset, shape=(rows,))
+    return vectors, ids
+
+
+def convert_clip_folder(clip_path, output_file, dtype=np.float32):
+    """
+    Converts the folder with one .pt file per image to the packed file.
+
+    Args:
+        clip_path (str): The path to folder with preprocessed CLIP data.
+        output_file (str): The path of the created packed file.
+        dtype: The type used for storing of the vectors (float32 or float16).
+    """
+    import torch
+
+    names = sorted(fn for fn in os.listdir(clip_path) if fn.endswith(".pt"))
+    vectors = torch.cat([torch.load(os.path.join(clip_path, fn), map_location="cpu") for fn in names])
+    vectors = vectors.float().numpy()
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    write_packed(output_file, vectors, [int(fn[:-3]) for fn in names], dtype)
+
+
+def _write(path, dtype, shape, vectors, ids):
+    # writes the header and the parts of the matrix and of the table of ids to a temporary file, which replaces path
+    code = [k for k, v in DTYPES.items() if v == dtype][0]
+    rows, dim = shape
+    ids_offset = _align(HEADER_SIZE + rows * dim * dtype.itemsize)
+
+    with atomic_write(path) as f:
+        f.write(HEADER.pack(MAGIC, VERSION, code, rows, dim, HEADER_SIZE, ids_offset).ljust(HEADER_SIZE, b"\x00"))
+        for part in vectors:
+            np.ascontiguousarray(part).tofile(f)
+        f.write(b"\x00" * (ids_offset - HEADER_SIZE - rows * dim * dtype.itemsize))
+        for part in ids:
+            np.ascontiguousarray(part).tofile(f)
+
+
+def _align(offset, alignment=HEADER_SIZE):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+if __name__ == "__main__":
+    # usage: python -m gas.embeddings <clip folder> <packed file> [float16]
+    convert_clip_folder(sys.argv[1], sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else np.float32)
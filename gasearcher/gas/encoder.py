@@ -0,0 +1,231 @@
+import atexit
+import os
+import queue
+import threading
+import time
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import clip
+import numpy as np
+import torch
+
+from gas.files import atomic_write
+
+
+class TextEncoder:
+    """
+    Encodes text queries to normalized feature vectors using CLIP. Queries arriving from concurrent requests within
+    a short time window are collected and encoded by one batched forward pass of the model.
+
+    Attributes:
+        model: The pre-trained CLIP model.
+        device: A string indicating whether to use CPU or GPU for running the CLIP model.
+        window (float): The time (in seconds) for which queries are collected to one batch (0 = no batching).
+        max_batch (int): The maximal number of queries encoded in one batch.
+    """
+
+    def __init__(self, model, device, window=0.005, max_batch=32):
+        """
+        Args:
+            model: The pre-trained CLIP model.
+            device: A string indicating whether to use CPU or GPU for running the CLIP model.
+            window (float): The time (in seconds) for which queries are collected to one batch (0 = no batching).
+            max_batch (int): The maximal number of queries encoded in one batch.
+        """
+        self.model = model
+        self.device = device
+        self.window = window
+        self.max_batch = max_batch
+        self._requests = queue.Queue()
+        if window > 0:
+            threading.Thread(target=self._run, name="text-encoder", daemon=True).start()
+
+    def encode(self, queries):
+        """
+        Encodes the queries (all queries of one call are always encoded in the same batch).
+
+        Args:
+            queries (list): A list of text queries.
+
+        Returns:
+            numpy.ndarray: A 2D float32 matrix of normalized feature vectors (one row per query).
+        """
+        if self.window <= 0:
+            return self._encode_batch(queries)
+
+        future = Future()
+        self._requests.put((queries, future))
+        return future.result()
+
+    def _encode_batch(self, queries):
+        return self._encode_tokens(self._tokenize(queries))
+
+    def _tokenize(self, queries):
+        return clip.tokenize(queries)
+
+    def _encode_tokens(self, tokens):
+        with torch.no_grad():
+            text_features = self.model.encode_text(tokens.to(self.device))
+        text_features = text_features.cpu().numpy().astype(np.float32)
+        return text_features / np.linalg.norm(text_features, axis=1, keepdims=True)
+
+    def _run(self):
+        while True:
+            # wait for the first request and then collect other requests until the window ends
+            batch = [self._requests.get()]
+            size = len(batch[0][0])
+            deadline = time.monotonic() + self.window
+            while size < self.max_batch and time.monotonic() < deadline:
+                try:
+                    batch.append(self._requests.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+                size += len(batch[-1][0])
+
+            # each request is tokenized separately, so an invalid query (e.g. too long) fails only its own request
+            tokenized = []
+            for queries, future in batch:
+                try:
+                    tokenized.append((self._tokenize(queries), future))
+                except Exception as e:
+                    future.set_exception(e)
+            if not tokenized:
+                continue
+
+            try:
+                text_features = self._encode_tokens(torch.cat([tokens for tokens, _ in tokenized]))
+            except Exception as e:
+                for _, future in tokenized:
+                    future.set_exception(e)
+                continue
+
+            # fan results back to the callers
+            start = 0
+            for tokens, future in tokenized:
+                future.set_result(text_features[start:start + len(tokens)])
+                start += len(tokens)
+
+
+class TextEmbeddingCache:
+    """
+    Bounded thread-safe LRU cache of feature vectors of text queries (queries are normalized, so the same phrase
+    with different case or spacing is encoded only once).
+
+    Attributes:
+        size (int): The maximal number of cached queries.
+        ttl (float): The time (in seconds) after which the cached vector expires (None for no expiration).
+        path (str): The path to the file where the cache is persisted (None for no persistence).
+        hits (int): The number of queries found in the cache.
+        misses (int): The number of queries not found in the cache.
+    """
+
+    def __init__(self, size=1024, ttl=None, path=None):
+        """
+        Args:
+            size (int): The maximal number of cached queries.
+            ttl (float): The time (in seconds) after which the cached vector expires (None for no expiration).
+            path (str): The path to the file where the cache is persisted (None for no persistence).
+        """
+        self.size = size
+        self.ttl = ttl
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()  # normalized query -> (time of insertion, vector)
+        self._lock = threading.Lock()
+
+        if path:
+            if os.path.exists(path):
+                self.load()
+            atexit.register(self.save)
+
+    @staticmethod
+    def normalize(query):
+        """
+        Normalizes the query in the same way as the CLIP tokenizer does (case and whitespace).
+
+        Args:
+            query (str): The text query.
+
+        Returns:
+            str: The normalized query.
+        """
+        return " ".join(query.lower().split())
+
+    def get(self, query):
+        """
+        Gets the cached feature vector of the query.
+
+        Args:
+            query (str): The text query.
+
+        Returns:
+            numpy.ndarray: The feature vector of the query or None if it is not cached.
+        """
+        key = self.normalize(query)
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and self.ttl is not None and time.time() - item[0] > self.ttl:
+                del self._items[key]
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, query, vector):
+        """
+        Saves the feature vector of the query to the cache (the least recently used query is removed if it is full).
+
+        Args:
+            query (str): The text query.
+            vector (numpy.ndarray): The feature vector of the query.
+        """
+        if self.size <= 0:
+            return
+        key = self.normalize(query)
+        with self._lock:
+            self._items[key] = (time.time(), vector)
+            self._items.move_to_end(key)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def stats(self):
+        """
+        Returns:
+            dict: The number of cached queries, hits and misses.
+        """
+        with self._lock:
+            return {'size': len(self._items), 'hits': self.hits, 'misses': self.misses}
+
+    def save(self):
+        """
+        Saves the cache to the file.
+        """
+        with self._lock:
+            items = list(self._items.items())
+        if not items:
+            return
+        with atomic_write(self.path) as f:
+            np.savez(f, queries=np.array([key for key, _ in items]),
+                     times=np.array([t for _, (t, _) in items]), vectors=np.stack([v for _, (_, v) in items]))
+
+    def load(self):
+        """
+        Loads the cache from the file (expired queries are skipped). An unreadable file is treated as an empty cache,
+        so a damaged file never stops the server from starting.
+        """
+        try:
+            with np.load(self.path) as f:
+                items = list(zip(f['queries'].tolist(), f['times'].tolist(), f['vectors']))
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile) as e:
+            print(f"text cache {self.path} is not readable ({e}), starting with an empty cache")
+            return
+        with self._lock:
+            for key, t, vector in items[-self.size:] if self.size > 0 else []:
+                if self.ttl is None or time.time() - t <= self.ttl:
+                    self._items[key] = (t, vector)
@@ -0,0 +1,26 @@
+import contextlib
+import os
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode="wb"):
+    """
+    Opens a temporary file which replaces the file at path when the block ends without an error, so other processes
+    never read a partially written file. The temporary file is named by the process, so processes which write
+    the same file at once do not interleave their content (the last replace wins).
+
+    Args:
+        path (str): The path of the written file.
+        mode (str): The mode in which the temporary file is opened ("wb" or "w").
+
+    Yields:
+        file: The opened temporary file.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
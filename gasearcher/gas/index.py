@@ -0,0 +1,207 @@
+import numpy as np
+
+from gas.files import atomic_write
+
+CHUNK = 65536  # rows processed at once when assigning vectors to centroids
+
+
+class IVFIndex:
+    """
+    Approximate nearest-neighbour index of normalized feature vectors (inverted file index). The vectors are partitioned
+    by k-means to lists and only the lists closest to the query are searched. Residuals of vectors (to the centroid of
+    their list) can be compressed by product quantization, then the candidates are scored approximately and only
+    the best of them are re-ranked exactly.
+
+    Attributes:
+        centroids (numpy.ndarray): A 2D matrix with centroid of each list.
+        list_offsets (numpy.ndarray): The start of each list in list_ids (CSR-style, the last value is the end).
+        list_ids (numpy.ndarray): The indexes of images ordered by their list.
+        codebooks (numpy.ndarray): The codebooks of product quantization (subvectors x 256 x dim of subvector) or None.
+        codes (numpy.ndarray): The quantized residuals (aligned with list_ids) or None.
+        n_probe (int): The number of lists searched for each query.
+    """
+
+    def __init__(self, centroids, list_offsets, list_ids, codebooks=None, codes=None, n_probe=16):
+        """
+        Args:
+            centroids (numpy.ndarray): A 2D matrix with centroid of each list.
+            list_offsets (numpy.ndarray): The start of each list in list_ids.
+            list_ids (numpy.ndarray): The indexes of images ordered by their list.
+            codebooks (numpy.ndarray): The codebooks of product quantization or None.
+            codes (numpy.ndarray): The quantized residuals or None.
+            n_probe (int): The number of lists searched for each query.
+        """
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_ids = list_ids
+        self.codebooks = codebooks
+        self.codes = codes
+        self.n_probe = n_probe
+
+    @classmethod
+    def build(cls, data, n_lists=256, n_subvectors=0, n_probe=16, iterations=10, seed=0):
+        """
+        Builds the index from the matrix of normalized feature vectors.
+
+        Args:
+            data (numpy.ndarray): A 2D matrix of normalized feature vectors (one row per image).
+            n_lists (int): The number of lists (clusters).
+            n_subvectors (int): The number of subvectors of product quantization (0 means without quantization).
+            n_probe (int): The number of lists searched for each query.
+            iterations (int): The number of iterations of k-means.
+            seed (int): The seed of random generator.
+
+        Returns:
+            IVFIndex: The built index.
+        """
+        rng = np.random.default_rng(seed)
+        data = np.asarray(data, dtype=np.float32)
+        n_lists = min(n_lists, len(data))
+
+        centroids = _kmeans(data, n_lists, iterations, rng, spherical=True)
+        assignment = _assign(data, centroids, spherical=True)
+        list_ids = np.argsort(assignment, kind="stable")
+        list_offsets = np.searchsorted(assignment[list_ids], np.arange(n_lists + 1))
+
+        codebooks, codes = None, None
+        if n_subvectors:
+            residuals = data[list_ids] - centroids[assignment[list_ids]]
+            codebooks, codes = _train_pq(residuals, n_subvectors, iterations, rng)
+
+        return cls(centroids, list_offsets, list_ids, codebooks, codes, n_probe)
+
+    def save(self, path):
+        """
+        Saves the index to the file.
+
+        Args:
+            path (str): The path to the file (.npz).
+        """
+        arrays = {'centroids': self.centroids, 'list_offsets': self.list_offsets, 'list_ids': self.list_ids}
+        if self.codebooks is not None:
+            arrays.update(codebooks=self.codebooks, codes=self.codes)
+        with atomic_write(path) as f:
+            np.savez(f, **arrays)
+
+    @classmethod
+    def load(cls, path, n_probe=16):
+        """
+        Loads the index from the file.
+
+        Args:
+            path (str): The path to the file (.npz).
+            n_probe (int): The number of lists searched for each query.
+
+        Returns:
+            IVFIndex: The loaded index.
+        """
+        with np.load(path) as f:
+            return cls(f['centroids'], f['list_offsets'], f['list_ids'], f['codebooks'] if 'codebooks' in f else None,
+                       f['codes'] if 'codes' in f else None, n_probe)
+
+    def search(self, query, k, data):
+        """
+        Searches k nearest images to the query. The returned distances are exact (computed from data).
+
+        Args:
+            query (numpy.ndarray): A 1D normalized feature vector of the query.
+            k (int): The number of returned images.
+            data (numpy.ndarray): A 2D matrix of normalized feature vectors used for exact scoring of candidates.
+
+        Returns:
+            tuple: The indexes of images and their distances (from 0 to 2) sorted by the distance.
+        """
+        query = np.asarray(query, dtype=np.float32).ravel()
+
+        # nearest lists
+        coarse = self.centroids @ query
+        probe = np.argpartition(-coarse, min(self.n_probe, len(coarse)) - 1)[:self.n_probe]
+        positions = np.concatenate([np.arange(self.list_offsets[i], self.list_offsets[i + 1]) for i in probe])
+        candidates = self.list_ids[positions]
+
+        if self.codebooks is not None and len(candidates) > k:
+            # approximate score (centroid + quantized residual) and keep only the best candidates for exact scoring
+            n_subvectors, _, sub_dim = self.codebooks.shape
+            table = np.einsum('mkd,md->mk', self.codebooks, query.reshape(n_subvectors, sub_dim))
+            list_of_position = np.searchsorted(self.list_offsets, positions, side='right') - 1
+            approx = coarse[list_of_position] + table[np.arange(n_subvectors), self.codes[positions]].sum(axis=1)
+            candidates = candidates[np.argpartition(-approx, k - 1)[:k]]
+
+        distances = 1 - data[candidates] @ query
+        best = np.argsort(distances, kind="stable")[:k]
+        return candidates[best], distances[best]
+
+
+def recall_at_k(index, data, queries, k):
+    """
+    Computes the recall of the index against the exact search (the fraction of exact top k found by the index).
+
+    Args:
+        index (IVFIndex): The approximate index.
+        data (numpy.ndarray): A 2D matrix of normalized feature vectors.
+        queries (numpy.ndarray): A 2D matrix of normalized feature vectors of queries.
+        k (int): The number of compared results.
+
+    Returns:
+        float: The average recall@k.
+    """
+    recall = 0
+    for query in queries:
+        exact = np.argpartition(1 - data @ query, k - 1)[:k]
+        approx, _ = index.search(query, k, data)
+        recall += len(np.intersect1d(exact, approx)) / k
+    return recall / len(queries)
+
+
+def _assign(data, centroids, spherical):
+    # nearest centroid of each vector (by dot product for normalized vectors, otherwise by L2 distance)
+    norms = 0 if spherical else (centroids ** 2).sum(axis=1) / 2
+    return np.concatenate([np.argmax(data[i:i + CHUNK] @ centroids.T - norms, axis=1)
+                           for i in range(0, len(data), CHUNK)])
+
+
+def _kmeans(data, k, iterations, rng, spherical):
+    centroids = data[rng.choice(len(data), k, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = _assign(data, centroids, spherical)
+        counts = np.bincount(assignment, minlength=k)
+
+        # empty clusters keep their previous centroid
+        filled = counts > 0
+        order = np.argsort(assignment, kind="stable")
+        sums = np.add.reduceat(data[order], np.concatenate([[0], np.cumsum(counts)[:-1]])[filled])
+        centroids[filled] = sums / counts[filled, None]
+        if spherical:
+            centroids[filled] /= np.linalg.norm(centroids[filled], axis=1, keepdims=True)
+    return centroids
+
+
+def _train_pq(residuals, n_subvectors, iterations, rng, n_codes=256, max_train=65536):
+    n, dim = residuals.shape
+    if dim % n_subvectors:
+        raise ValueError(f"Dimension {dim} is not divisible by the number of subvectors {n_subvectors}.")
+    sub_dim = dim // n_subvectors
+    n_codes = min(n_codes, n)
+    sample = residuals[rng.choice(n, min(n, max_train), replace=False)]
+
+    codebooks = np.empty((n_subvectors, n_codes, sub_dim), dtype=np.float32)
+    codes = np.empty((n, n_subvectors), dtype=np.uint8)
+    for m in range(n_subvectors):
+        part = slice(m * sub_dim, (m + 1) * sub_dim)
+        codebooks[m] = _kmeans(sample[:, part], n_codes, iterations, rng, spherical=False)
+        codes[:, m] = _assign(residuals[:, part], codebooks[m], spherical=False)
+    return codebooks, codes
+
+
+if __name__ == "__main__":
+    # usage: python -m gas.index (builds the index of current dataset defined in settings)
+    from gas.data import LoaderDatabase
+    from gas.settings import PATH_DATA, SEA_DATABASE, INDEX_LISTS, INDEX_SUBVECTORS, INDEX_PROBE, SHOWING
+
+    loader = LoaderDatabase(PATH_DATA, SEA_DATABASE)
+    clip_data = loader.get_clip_data()
+    index = IVFIndex.build(clip_data, INDEX_LISTS, INDEX_SUBVECTORS, INDEX_PROBE)
+    index.save(loader.path_index)
+
+    sample = clip_data[np.random.default_rng(0).choice(len(clip_data), min(100, len(clip_data)), replace=False)]
+    print(f"recall@{SHOWING}: {recall_at_k(index, clip_data, sample, min(SHOWING, len(clip_data))):.3f}")
@@ -1,86 +1,238 @@
+import atexit
+import json
+import queue
+import threading
+import time
+
 import numpy as np
 
-from gas.settings import SHOWING, PATH_LOG, PATH_LOG_SIMILARITY
+from gas.metrics import metrics
+from gas.settings import SHOWING, PATH_LOG, PATH_LOG_SIMILARITY, PATH_LOG_JSON, LOG_FORMAT, LOG_QUEUE_SIZE, \
+    LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL
+
+
+class LogWriter:
+    """
+    Writes lines of logs in a background thread, so requests only put the line to the bounded queue. The lines are
+    appended to files in batches (when the batch is full or the interval from the first line of the batch passes)
+    and the rest is written at exit. Lines are dropped if the queue is full.
+
+    Attributes:
+        batch_size (int): The maximal number of lines written at once.
+        interval (float): The maximal time (in seconds) for which lines wait in the queue.
+        written (int): The number of written lines.
+        dropped (int): The number of lines dropped because of full queue or error of writing.
+    """
+
+    _STOP = object()
+
+    def __init__(self, max_queue=10000, batch_size=256, interval=1.0):
+        """
+        Args:
+            max_queue (int): The maximal number of lines waiting for writing.
+            batch_size (int): The maximal number of lines written at once.
+            interval (float): The maximal time (in seconds) for which lines wait in the queue.
+        """
+        self.batch_size = batch_size
+        self.interval = interval
+        self.written = 0
+        self.dropped = 0
+        self._queue = queue.Queue(max_queue)
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def write(self, path, line):
+        """
+        Puts the line to the queue (without waiting).
+
+        Args:
+            path (str): The path of the log file.
+            line (str): The line (with the end of line).
+        """
+        try:
+            self._queue.put_nowait((path, line))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def flush(self):
+        """
+        Waits until all queued lines are written.
+        """
+        if self._thread.is_alive():
+            self._queue.join()
+
+    def close(self):
+        """
+        Writes all queued lines and stops the background thread.
+        """
+        if self._thread.is_alive():
+            self._queue.put(self._STOP)
+            self._thread.join()
+
+    def stats(self):
+        """
+        Returns:
+            dict: The number of queued, written and dropped lines.
+        """
+        return {'queued': self._queue.qsize(), 'written': self.written, 'dropped': self.dropped}
+
+    def _run(self):
+        stop = False
+        while not stop:
+            # wait for the first line and then collect other lines until the batch is full or the interval passes
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size and batch[-1] is not self._STOP:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+
+            stop = batch[-1] is self._STOP
+            lines = [item for item in batch if item is not self._STOP]
+            self._write(lines)
+            for _ in batch:
+                self._queue.task_done()
+
+    def _write(self, lines):
+        # each file is opened once for the whole batch
+        files = {}
+        for path, line in lines:
+            files.setdefault(path, []).append(line)
+        for path, file_lines in files.items():
+            try:
+                with open(path, "a") as log:
+                    log.write("".join(file_lines))
+                self.written += len(file_lines)
+            except OSError as e:
+                print(f"writing to {path} failed: {e}")
+                with self._lock:
+                    self.dropped += len(file_lines)
 
 
 class Logger:
     """
-    Log text and image queries.
+    Log text and image queries. Queries are logged to semicolon-separated files and/or to newline-delimited JSON file
+    (one object per query with the fields action, query, target, session, rank, timestamp, elapsed, activity and
+    durations of stages of the request).
 
     Attributes:
         path_log (str): The path of the log file for queries.
+        path_log_similarity (str): The path of the log file for image queries and bayes updates.
+        path_log_json (str): The path of the structured log file for all queries.
+        log_format (str): The format of logs ("csv", "json" or "both").
         same_video (dict): A dictionary containing the limit indices bounding images context (surrounding in same video).
         targets (list) : The indexes of images which are searched for.
+        writer (LogWriter): The background writer of log files.
     """
 
-    def __init__(self, path_data, same_video, targets, is_sea_database):
+    def __init__(self, path_data, same_video, targets, is_sea_database, writer=None, log_format=LOG_FORMAT):
         """
         Args:
             path_data (str): The path to data.
             same_video (dict): A dictionary containing the limit indices bounding images context (surrounding in same video).
             targets (list): The indexes of images which are searched for.
+            writer (LogWriter): The background writer of log files (created from settings by default).
+            log_format (str): The format of logs ("csv", "json" or "both").
         """
         self.path_log = path_data + ("sea_log.csv" if is_sea_database else PATH_LOG)
         self.path_log_similarity = path_data + ("sea_log_similarity.csv" if is_sea_database else PATH_LOG_SIMILARITY)
+        self.path_log_json = path_data + ("sea_log.jsonl" if is_sea_database else PATH_LOG_JSON)
+        self.log_format = log_format
         self.same_video = same_video  # indexes of images in same video (high probability of same looking photos)
         self.targets = targets
+        self.writer = writer if writer is not None else LogWriter(LOG_QUEUE_SIZE, LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL)
 
-    def log_text_query(self, query, new_result, target, session, activity):
+    def log_text_query(self, query, scores, target, session, activity, elapsed=None):
         """
         Logs a text query.
 
         Args:
             query (str): The query text.
-            new_result (list): A list of indices of images sorted (in order) by similarity to the current text query.
+            scores (numpy.ndarray): The distance of each image to the current text query (lower is better).
             target (int): The order of the currently searching image in targets.
             session (str): The unique session ID of the user.
             activity (str): The activity from the user.
+            elapsed (float): The time (in seconds) of the search.
         """
-        # write down log
-        with open(self.path_log, "a") as log:
-            log.write(f'{query};{str(self.targets[target])};{session};' + str(
-                self.get_rank(new_result, self.targets[target])) + f';"{activity}"\n')
+        rank = self.get_rank(scores, self.targets[target])
+        self._log("text", self.path_log, query, target, session, rank, elapsed, activity)
 
-    def log_image_query(self, query_id, new_result, target, session):
+    def log_temporal_query(self, query, scores, target, session, activity="", elapsed=None):
+        """
+        Logs a temporal query (only to the structured log, rows of CSV logs do not contain the type of action,
+        so the temporal query would be evaluated and replayed as a text query).
+
+        Args:
+            query (str): The query text (both parts separated by ">").
+            scores (numpy.ndarray): The combined distance of each image to the temporal query (lower is better).
+            target (int): The order of the currently searching image in targets.
+            session (str): The unique session ID of the user.
+            activity (str): The activity from the user.
+            elapsed (float): The time (in seconds) of the search.
+        """
+        rank = self.get_rank(scores, self.targets[target])
+        self._log("temporal", None, query, target, session, rank, elapsed, activity)
+
+    def log_image_query(self, query_id, scores, target, session, elapsed=None):
         """
         Logs an image query.
 
         Args:
             query_id (int): The query image ID.
-            new_result (list): A list of indices of images sorted (in order) by similarity to the current image query.
+            scores (numpy.ndarray): The distance of each image to the current image query (lower is better).
             target (int): The order of the currently searching image in targets.
             session (str): The unique session ID of the user.
+            elapsed (float): The time (in seconds) of the search.
         """
-        # write down log
-        with open(self.path_log_similarity, "a") as log:
-            log.write(f'{str(query_id)};{str(self.targets[target])};{session};' + str(
-                self.get_rank(new_result, self.targets[target])) + ';""\n')
+        rank = self.get_rank(scores, self.targets[target])
+        self._log("image", self.path_log_similarity, query_id, target, session, rank, elapsed)
 
-    def log_bayes_update(self, query_id, new_result, target, session):
+    def log_bayes_update(self, query_id, displayed, scores, target, session, elapsed=None):
         """
         Logs bayes update.
 
         Args:
             query_id (int): The query image ID.
-            new_result (list): A list of indices of images sorted (in order) after bayes update.
+            displayed (list): A list of indices of images which were updated (the previously shown images).
+            scores (numpy.ndarray): The score of each updated image after bayes update (lower is better).
             target (int): The order of the currently searching image in targets.
             session (str): The unique session ID of the user.
+            elapsed (float): The time (in seconds) of the update.
         """
-        # write down log
-        with open(self.path_log_similarity, "a") as log:
-            log.write(f'{str(query_id)};{str(self.targets[target])};{session};' + str(
-                self.get_rank(new_result, self.targets[target])) + ';""\n')
+        # rank is undefined if the searched image was not shown
+        displayed = list(displayed)
+        rank = self.get_rank(scores, displayed.index(self.targets[target])) if self.targets[target] in displayed else -1
+        self._log("bayes", self.path_log_similarity, query_id, target, session, rank, elapsed)
+
+    def _log(self, action, path, query, target, session, rank, elapsed=None, activity=""):
+        # write down log (actions without the CSV log have no path)
+        if path is not None and self.log_format in ("csv", "both"):
+            self.writer.write(path, f'{str(query)};{str(self.targets[target])};{session};{rank};"{activity}"\n')
+        if self.log_format in ("json", "both"):
+            self.writer.write(self.path_log_json, json.dumps({
+                'action': action, 'query': str(query), 'target': int(self.targets[target]), 'session': session,
+                'rank': rank, 'timestamp': round(time.time(), 3),
+                'elapsed': None if elapsed is None else round(elapsed, 6), 'activity': activity,
+                'stages': metrics.current()}) + "\n")
 
     @staticmethod
-    def get_rank(result, index):
+    def get_rank(scores, index):
         """
-        Get rank (from 1) of image.
+        Get rank (from 1) of image directly from scores (without sorting). The rank is the number of images with
+        strictly better (lower) score plus one, so images with the same score as given image are ranked after it.
+        Image with infinite score (not found by approximate search) has undefined rank -1.
 
         Args:
-            result (list): A list of indices of images sorted (in order) by similarity to the current query
+            scores (numpy.ndarray): The score of each image (lower is better).
             index (int): The index of the image
 
         Returns:
             int: The rank of given image
         """
-        return result.index(index) + 1
+        if not np.isfinite(scores[index]):
+            return -1
+        return int(np.count_nonzero(scores < scores[index])) + 1
@@ -0,0 +1,152 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+from gas.settings import METRICS_MEMORY
+
+# upper bounds (in seconds) of buckets of histograms of stage durations
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# statistics of components which only grow (exported as counters, other statistics are exported as gauges)
+COUNTERS = ('hits', 'misses', 'evictions', 'written', 'dropped')
+
+
+class Metrics:
+    """
+    Collects durations of stages of the search pipeline (encoding, scoring, sorting, bayes update, logging, rendering
+    and whole views) to histograms exported in Prometheus text format. Durations of stages of the current request
+    are also kept per thread, so they can be attached to the query log.
+
+    Attributes:
+        buckets (numpy.ndarray): The upper bounds of buckets of histograms.
+        memory (bool): Whether the memory used by the process is reported.
+    """
+
+    def __init__(self, buckets=BUCKETS, memory=False):
+        """
+        Args:
+            buckets (tuple): The upper bounds (in seconds) of buckets of histograms.
+            memory (bool): Whether the memory used by the process is reported.
+        """
+        self.buckets = np.asarray(buckets, dtype=np.float64)
+        self.memory = memory
+        self._histograms = {}  # stage -> (counts of buckets with +Inf, sum of durations)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def timer(self, stage):
+        """
+        Measures the duration of the stage (used as context manager).
+
+        Args:
+            stage (str): The name of the stage.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    @contextmanager
+    def request(self, view):
+        """
+        Measures the duration of the view and starts collecting of stages of the current request.
+
+        Args:
+            view (str): The name of the view.
+        """
+        self._local.stages = {}
+        with self.timer(f"view_{view}"):
+            yield
+
+    def observe(self, stage, seconds):
+        """
+        Adds the duration of the stage.
+
+        Args:
+            stage (str): The name of the stage.
+            seconds (float): The duration of the stage.
+        """
+        bucket = int(np.searchsorted(self.buckets, seconds))
+        with self._lock:
+            counts, total = self._histograms.get(stage, (np.zeros(len(self.buckets) + 1, dtype=np.int64), 0.0))
+            counts[bucket] += 1
+            self._histograms[stage] = (counts, total + seconds)
+
+        stages = getattr(self._local, 'stages', None)
+        if stages is not None:
+            stages[stage] = stages.get(stage, 0.0) + seconds
+
+    def current(self):
+        """
+        Returns:
+            dict: The durations (in seconds) of stages of the current request.
+        """
+        return {stage: round(seconds, 6) for stage, seconds in getattr(self._local, 'stages', {}).items()}
+
+    def render(self, stats=None):
+        """
+        Exports the metrics in Prometheus text format.
+
+        Args:
+            stats (dict): The statistics of components by the name of component (e.g. resident sessions, hits
+                of the cache of text queries and dropped lines of the log), exported as `gas_<component>_<name>`.
+
+        Returns:
+            str: The histograms of stage durations, the statistics of components (and the memory of the process
+                if enabled).
+        """
+        with self._lock:
+            histograms = {stage: (counts.copy(), total) for stage, (counts, total) in self._histograms.items()}
+
+        lines = ["# HELP gas_stage_seconds Duration of stages of the search pipeline.",
+                 "# TYPE gas_stage_seconds histogram"]
+        for stage, (counts, total) in sorted(histograms.items()):
+            cumulative = np.cumsum(counts)
+            for bound, count in zip([*map(str, self.buckets), "+Inf"], cumulative):
+                lines.append(f'gas_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+            lines.append(f'gas_stage_seconds_sum{{stage="{stage}"}} {total}')
+            lines.append(f'gas_stage_seconds_count{{stage="{stage}"}} {cumulative[-1]}')
+
+        for component, values in (stats or {}).items():
+            for name, value in values.items():
+                kind = "counter" if name in COUNTERS else "gauge"
+                metric = f"gas_{component}_{name}" + ("_total" if kind == "counter" else "")
+                lines += [f"# TYPE {metric} {kind}", f"{metric} {value}"]
+
+        if self.memory:
+            resident, peak = memory_usage()
+            lines += ["# HELP gas_memory_resident_bytes Resident memory of the process.",
+                      "# TYPE gas_memory_resident_bytes gauge",
+                      f"gas_memory_resident_bytes {resident}",
+                      "# HELP gas_memory_peak_bytes Peak resident memory of the process.",
+                      "# TYPE gas_memory_peak_bytes gauge",
+                      f"gas_memory_peak_bytes {peak}"]
+        return "\n".join(lines) + "\n"
+
+
+def memory_usage():
+    """
+    Gets the current and the peak resident memory of the process (0 if it is not known on the platform).
+
+    Returns:
+        tuple: The current and the peak resident memory in bytes.
+    """
+    resident, peak = 0, 0
+    try:
+        with open("/proc/self/statm") as f:
+            resident = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except ImportError:
+        pass
+    return resident, peak
+
+
+metrics = Metrics(memory=METRICS_MEMORY)
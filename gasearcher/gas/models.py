@@ -1,17 +1,230 @@
-from gas.data import LoaderDatabase
-from gas.logger import Logger
-from gas.searcher import Searcher
-from gas.settings import SEA_DATABASE, COMBINATION, PATH_DATA, SUR, SHOWING
+import os
+import threading
+import time
 
-loader = LoaderDatabase(PATH_DATA, SEA_DATABASE)
-class_data = loader.get_photos_classes()
-classes, class_pr = loader.get_classes()
+from gas.settings import SEA_DATABASE, COMBINATION, PATH_DATA, SUR, SHOWING, USING_INDEX, TEXT_CACHE_SIZE, \
+    TEXT_CACHE_TTL, TEXT_CACHE_PERSIST, MULTIPROCESS, SESSION_MAX, SESSION_TTL, SESSION_MAX_BYTES, FIRST_SCREENS, \
+    EMBEDDING_PRECISION, RELOAD_INTERVAL
 
-size_dataset = len(class_data)
-targets = loader.set_finding(size_dataset)
 
-# the initial set of images indexes to be shown in the search result
-first_show = loader.load_first_screen(class_data, size_dataset, targets)
+class Resources:
+    """
+    Data and objects necessary for searching. They are loaded on the first use (or by the background warm-up),
+    so importing of the application (e.g. by manage.py commands) does not load the dataset and the CLIP model.
+    Data of newly ingested videos are reloaded in background (if `RELOAD_INTERVAL` is set in settings).
+    A process forked while the warm-up runs (e.g. a worker of `gunicorn --preload`) discards the components
+    of the parent and starts its own warm-up.
 
-searcher = Searcher(loader.get_clip_data(), COMBINATION,
-                    Logger(PATH_DATA, loader.get_context(size_dataset, SUR), targets, SEA_DATABASE), SHOWING)
+    Attributes:
+        loader (LoaderDatabase): The loader of the current dataset.
+        class_data (numpy.ndarray): The matrix of top classes of each image.
+        classes (list): The names of classes.
+        class_pr (dict): The probability of each class.
+        size_dataset (int): The number of images in the dataset.
+        targets (list): The indexes of images that should be found.
+        class_table (ClassTable): The classes of images in arrays.
+        first_show (list): The initial sets of images indexes to be shown in the search result.
+        sessions (SqliteSessionStore): The store of states of sessions shared by processes (None for one process).
+        searcher (Searcher): The searcher of the current dataset.
+        timings (dict): The time (in seconds) of loading of each loaded component.
+        error (str): The error of the failed loading (None if loading did not fail).
+    """
+
+    COMPONENTS = ('loader', 'class_data', 'classes', 'class_pr', 'size_dataset', 'targets', 'class_table',
+                  'first_show', 'sessions', 'searcher')
+
+    def __init__(self):
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def __getattr__(self, name):
+        # called only for attributes which are not set yet
+        if name not in self.COMPONENTS:
+            raise AttributeError(name)
+        self.load()
+        return self.__dict__[name]
+
+    @property
+    def ready(self):
+        """
+        Returns:
+            bool: Whether all components are loaded.
+        """
+        return all(name in self.__dict__ for name in self.COMPONENTS)
+
+    def load(self):
+        """
+        Loads all components (only once, concurrent callers wait for the end of loading).
+        """
+        with self._lock:
+            if self.ready:
+                return
+            try:
+                self._load()
+            except Exception as e:
+                self.error = repr(e)
+                raise
+
+    def warm_up(self):
+        """
+        Starts loading of all components in a background thread (only once, later calls return the same thread).
+
+        Returns:
+            threading.Thread: The thread of loading.
+        """
+        if self._warming is None:
+            self._warming = threading.Thread(target=self._warm_up, name="warm-up", daemon=True)
+            self._warming.start()
+        return self._warming
+
+    def status(self):
+        """
+        Returns:
+            dict: Whether the resources are ready, which components are loaded (with time of loading) and the error.
+        """
+        return {'ready': self.ready, 'components': {name: name in self.__dict__ for name in self.COMPONENTS},
+                'timings': dict(self.timings), 'error': self.error}
+
+    def stats(self):
+        """
+        Returns:
+            dict: The statistics of the store of sessions, the cache of text queries and the writer of logs
+                (empty until the searcher is loaded).
+        """
+        searcher = self.__dict__.get('searcher')
+        if searcher is None:
+            return {}
+        return {'sessions': searcher.sessions.stats(), 'text_cache': searcher.text_cache.stats(),
+                'log': searcher.logger.writer.stats()}
+
+    def reload(self):
+        """
+        Reloads data of the dataset if new videos were ingested (the packed file was replaced). The table of classes
+        is replaced before the searcher, so classes of all images found by any searcher are known. Searches
+        in progress finish with the previous searcher.
+
+        Returns:
+            bool: Whether the data were reloaded.
+        """
+        from gas.classes import ClassTable
+
+        with self._lock:
+            loader = self.loader
+            snapshot = loader.get_snapshot_time()
+            if snapshot is None or snapshot == self._snapshot:
+                return False
+
+            start = time.perf_counter()
+            class_data = loader.get_photos_classes()
+            clip_data, quantized = loader.get_quantized_data(EMBEDDING_PRECISION, MULTIPROCESS)
+            size_dataset = len(class_data)
+            if len(quantized if clip_data is None else clip_data) != size_dataset:
+                return False  # the ingestion has not finished yet
+
+            searcher = self.searcher.with_data(clip_data, loader.get_video_ids(size_dataset), quantized,
+                                               loader.get_index(size_dataset) if USING_INDEX else None)
+            searcher.logger.same_video = loader.get_context(size_dataset, SUR)
+            self.__dict__.update(class_data=class_data, size_dataset=size_dataset,
+                                 class_table=ClassTable.from_matrix(class_data, len(self.classes)))
+            self.__dict__['searcher'] = searcher
+            self._snapshot = snapshot
+            self.timings['reload'] = round(time.perf_counter() - start, 3)
+            print(f'reloaded dataset with {size_dataset} images')
+            return True
+
+    def _watch(self):
+        while True:
+            time.sleep(RELOAD_INTERVAL)
+            try:
+                self.reload()
+            except Exception as e:
+                print(f'reload failed: {e!r}')  # the previous data are still used
+
+    def _reset(self):
+        for name in self.COMPONENTS:
+            self.__dict__.pop(name, None)
+        self.timings = {}
+        self.error = None
+        self._lock = threading.RLock()
+        self._snapshot = None  # time of modification of the loaded packed file
+        self._warming = None  # thread of the background loading
+
+    def _after_fork(self):
+        # threads do not survive fork, so the lock can be held by the warm-up thread of the parent forever
+        # and loaded components rely on threads which do not exist (writer of logs, batching of text queries,
+        # scoring pool), so the child loads its own components
+        warming = self._warming is not None
+        self._reset()
+        if warming:
+            self.warm_up()
+
+    def _warm_up(self):
+        try:
+            self.load()
+        except Exception:
+            pass  # the error is reported by status
+
+    def _set(self, name, function):
+        start = time.perf_counter()
+        value = function()
+        self.timings[name] = round(time.perf_counter() - start, 3)
+        self.__dict__[name] = value
+        return value
+
+    def _shared(self, key, value):
+        # the random values have to be same in all processes of the server (the first process of the server,
+        # identified by the parent process, wins)
+        if self.sessions is None:
+            return value
+        return self.sessions.setdefault(f"{key}_{os.getppid()}", value).tolist()
+
+    def _load(self):
+        # heavy modules (torch, CLIP, SOM) are imported only when the data are loaded
+        from gas.classes import ClassTable
+        from gas.data import LoaderDatabase
+        from gas.encoder import TextEmbeddingCache
+        from gas.logger import Logger
+        from gas.searcher import Searcher
+        from gas.sessions import SqliteSessionStore
+
+        loader = self._set('loader', lambda: LoaderDatabase(PATH_DATA, SEA_DATABASE))
+        self._snapshot = loader.get_snapshot_time()
+        class_data = self._set('class_data', loader.get_photos_classes)
+        classes, class_pr = loader.get_classes()
+        self._set('class_pr', lambda: class_pr)
+        self._set('classes', lambda: classes)
+
+        size_dataset = self._set('size_dataset', lambda: len(class_data))
+
+        # classes of images in arrays (used for classes of shown images and top classes of the result)
+        self._set('class_table', lambda: ClassTable.from_matrix(class_data, len(classes)))
+
+        # states of sessions are shared by all processes of the server
+        sessions = self._set('sessions', lambda: SqliteSessionStore(
+            loader.path_sessions, SESSION_MAX, SESSION_TTL, SESSION_MAX_BYTES) if MULTIPROCESS else None)
+
+        targets = self._set('targets', lambda: self._shared('targets', loader.set_finding(size_dataset)))
+
+        # the initial sets of images indexes to be shown in the search result (one of them is chosen for each session)
+        self._set('first_show', lambda: self._shared('first_show', loader.load_first_screen(
+            class_data, size_dataset, targets, FIRST_SCREENS)))
+
+        def searcher():
+            clip_data, quantized = loader.get_quantized_data(EMBEDDING_PRECISION, MULTIPROCESS)
+            return Searcher(
+                clip_data, COMBINATION,
+                Logger(PATH_DATA, loader.get_context(size_dataset, SUR), targets, SEA_DATABASE), SHOWING,
+                loader.get_index(size_dataset) if USING_INDEX else None,
+                TextEmbeddingCache(TEXT_CACHE_SIZE, TEXT_CACHE_TTL,
+                                   loader.path_text_cache if TEXT_CACHE_PERSIST else None),
+                loader.get_video_ids(size_dataset), sessions, quantized=quantized)
+
+        self._set('searcher', searcher)
+        self.error = None
+
+        if RELOAD_INTERVAL:
+            threading.Thread(target=self._watch, name="reload", daemon=True).start()
+
+
+resources = Resources()
@@ -0,0 +1,182 @@
+import numpy as np
+
+CHUNK = 1024  # rows converted to float32 at once (the rest of the matrix stays in reduced precision)
+PRECISIONS = ("float16", "int8")
+
+
+class QuantizedEmbeddings:
+    """
+    Normalized feature vectors stored with reduced precision: float16 or symmetric int8 with a scale per row.
+    Queries are scored in chunks, so the full float32 matrix is never created, and the best candidates can be
+    re-scored exactly with the float32 vectors (e.g. memory-mapped packed file).
+
+    Attributes:
+        codes (numpy.ndarray): A 2D matrix of quantized vectors (float16 or int8).
+        scales (numpy.ndarray): The scale of each row of int8 codes (None for float16).
+        precision (str): The precision of the codes ("float16" or "int8").
+    """
+
+    def __init__(self, codes, scales=None):
+        """
+        Args:
+            codes (numpy.ndarray): A 2D matrix of quantized vectors (float16 or int8).
+            scales (numpy.ndarray): The scale of each row of int8 codes (None for float16).
+        """
+        self.codes = codes
+        self.scales = scales
+        self.precision = codes.dtype.name
+
+    @classmethod
+    def quantize(cls, data, precision="int8"):
+        """
+        Quantizes the feature vectors (in chunks, so data can be a memory-mapped file).
+
+        Args:
+            data (numpy.ndarray): A 2D matrix of normalized feature vectors (one row per image).
+            precision (str): The precision of the codes ("float16" or "int8").
+
+        Returns:
+            QuantizedEmbeddings: The quantized vectors.
+        """
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision {precision}, use one of {PRECISIONS}.")
+        if precision == "float16":
+            return cls(np.asarray(data, dtype=np.float16))
+
+        codes = np.empty(data.shape, dtype=np.int8)
+        scales = np.empty(len(data), dtype=np.float32)
+        for start in range(0, len(data), CHUNK):
+            chunk = np.asarray(data[start:start + CHUNK], dtype=np.float32)
+            chunk_scales = np.abs(chunk).max(axis=1) / 127
+            chunk_scales[chunk_scales == 0] = 1
+            codes[start:start + CHUNK] = np.rint(chunk / chunk_scales[:, None])
+            scales[start:start + CHUNK] = chunk_scales
+        return cls(codes, scales)
+
+    @property
+    def nbytes(self):
+        """
+        Returns:
+            int: The number of bytes used by the codes and scales.
+        """
+        return self.codes.nbytes + (0 if self.scales is None else self.scales.nbytes)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, rows):
+        # dequantized float32 rows (used instead of the original vectors if they are not available)
+        vectors = self.codes[rows].astype(np.float32)
+        return vectors if self.scales is None else vectors * self.scales[rows][..., None]
+
+    def distances(self, query, start=0, stop=None):
+        """
+        Computes approximate distances of images (all images or one shard) to the query.
+
+        Args:
+            query (numpy.ndarray): A 1D normalized feature vector of the query.
+            start (int): The first scored image.
+            stop (int): The end of scored images (exclusive, None for all following images).
+
+        Returns:
+            numpy.ndarray: A 1D float32 array of distances (from 0 to 2) of each scored image to the query.
+        """
+        query = np.asarray(query, dtype=np.float32).ravel()
+        codes = self.codes[start:stop]
+        scores = np.empty(len(codes), dtype=np.float32)
+        # one small float32 buffer stays in cache, so the scoring reads only the compact codes from memory
+        buffer = np.empty((min(CHUNK, len(codes)), codes.shape[1]), dtype=np.float32)
+        for offset in range(0, len(codes), CHUNK):
+            chunk = buffer[:len(codes[offset:offset + CHUNK])]
+            np.copyto(chunk, codes[offset:offset + CHUNK], casting="unsafe")
+            np.matmul(chunk, query, out=scores[offset:offset + len(chunk)])
+        if self.scales is not None:
+            scores *= self.scales[start:stop]
+        return 1 - scores
+
+    def rescore(self, scores, query, data, candidates):
+        """
+        Replaces approximate distances of the best candidates by exact distances.
+
+        Args:
+            scores (numpy.ndarray): The approximate distances of all images (changed in place).
+            query (numpy.ndarray): A 1D normalized feature vector of the query.
+            data (numpy.ndarray): A 2D matrix of float32 normalized feature vectors.
+            candidates (int): The number of re-scored images.
+
+        Returns:
+            numpy.ndarray: The distances with exact values of the best candidates.
+        """
+        candidates = min(candidates, len(scores))
+        best = np.argpartition(scores, candidates - 1)[:candidates]
+        best.sort()  # sequential access to memory-mapped data
+        scores[best] = 1 - np.asarray(data[best], dtype=np.float32) @ np.asarray(query, dtype=np.float32).ravel()
+        return scores
+
+    def search(self, query, k, data=None, candidates=0):
+        """
+        Searches k nearest images to the query (the same interface as IVFIndex, used for the recall report).
+
+        Args:
+            query (numpy.ndarray): A 1D normalized feature vector of the query.
+            k (int): The number of returned images.
+            data (numpy.ndarray): A 2D matrix of float32 normalized feature vectors used for re-scoring.
+            candidates (int): The number of re-scored images (0 means without re-scoring).
+
+        Returns:
+            tuple: The indexes of images and their distances sorted by the distance.
+        """
+        scores = self.distances(query)
+        if candidates and data is not None:
+            scores = self.rescore(scores, query, data, max(k, candidates))
+        best = np.argpartition(scores, k - 1)[:k]
+        best = best[np.argsort(scores[best], kind="stable")]
+        return best, scores[best]
+
+
+class _Rescoring:
+    # adapter of the quantized search with re-scoring to the interface of recall_at_k
+    def __init__(self, quantized, candidates):
+        self.quantized = quantized
+        self.candidates = candidates
+
+    def search(self, query, k, data):
+        return self.quantized.search(query, k, data, self.candidates)
+
+
+def recall_report(data, queries, k, candidates=(0, 1000)):
+    """
+    Computes recall@k of quantized scoring (with and without re-scoring) against exact float32 search.
+
+    Args:
+        data (numpy.ndarray): A 2D matrix of float32 normalized feature vectors.
+        queries (numpy.ndarray): A 2D matrix of normalized feature vectors of queries.
+        k (int): The number of compared results.
+        candidates (tuple): The numbers of re-scored candidates (0 means without re-scoring).
+
+    Returns:
+        list: A list of dictionaries with precision, number of re-scored candidates, recall and bytes of codes.
+    """
+    from gas.index import recall_at_k
+
+    report = []
+    for precision in PRECISIONS:
+        quantized = QuantizedEmbeddings.quantize(data, precision)
+        for count in candidates:
+            report.append({'precision': precision, 'rescore': count, 'bytes': quantized.nbytes,
+                           'recall': round(recall_at_k(_Rescoring(quantized, count), data, queries, k), 4)})
+    return report
+
+
+if __name__ == "__main__":
+    # usage: python -m gas.quantization (recall of quantized scoring of current dataset defined in settings)
+    from gas.data import LoaderDatabase
+    from gas.settings import PATH_DATA, SEA_DATABASE, SHOWING, RESCORE_CANDIDATES
+
+    loader = LoaderDatabase(PATH_DATA, SEA_DATABASE)
+    clip_data = loader.get_clip_data()
+    sample = clip_data[np.random.default_rng(0).choice(len(clip_data), min(100, len(clip_data)), replace=False)]
+    print(f"float32: {np.asarray(clip_data).nbytes} bytes")
+    for row in recall_report(clip_data, sample, min(SHOWING, len(clip_data)), (0, RESCORE_CANDIDATES)):
+        print(f"{row['precision']} (re-scored {row['rescore']}): {row['bytes']} bytes, "
+              f"recall@{SHOWING}: {row['recall']:.3f}")
@@ -1,9 +1,54 @@
-import math
+import copy
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import clip
 import numpy as np
 import torch
 
+from gas.encoder import TextEmbeddingCache, TextEncoder
+from gas.metrics import metrics
+from gas.sessions import SessionStore
+from gas.settings import INDEX_CANDIDATES, RESCORE_CANDIDATES, SCORING_SHARDS, TEXT_CACHE_SIZE, TEXT_CACHE_TTL, \
+    TEXT_BATCH_WINDOW, TEXT_BATCH_SIZE, TEMPORAL_WINDOW, SESSION_MAX, SESSION_TTL, SESSION_MAX_BYTES
+
+MIN_SHARD_ROWS = 65536  # minimal number of images in one shard (smaller datasets are scored on the calling thread)
+
+
+def logsumexp(values, axis):
+    """
+    Compute log of sum of exponentials of values in numerically stable way.
+
+    Args:
+        values (numpy.ndarray): A 2D array of values.
+        axis (int): The axis over which the sum is taken.
+
+    Returns:
+        numpy.ndarray: A 1D array of results (-inf for empty sums).
+    """
+    if values.shape[axis] == 0:
+        return np.full(values.shape[1 - axis], -np.inf)
+    top = values.max(axis=axis, keepdims=True)
+    return (top + np.log(np.exp(values - top).sum(axis=axis, keepdims=True))).squeeze(axis)
+
+
+def top_k(scores, k):
+    """
+    Select indices of the k lowest scores (the best results) without sorting of the whole scores.
+
+    Args:
+        scores (numpy.ndarray): A 1D array representing the similarity distance of each image.
+        k (int): The number of selected results.
+
+    Returns:
+        numpy.ndarray: A 1D array of indices of k best results sorted (in order) by the score.
+    """
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    top = np.argpartition(scores, k - 1)[:k]
+    return top[np.argsort(scores[top], kind="stable")]
+
 
 class Searcher:
     """
@@ -11,51 +56,206 @@ class Searcher:
     It utilizes the CLIP (Contrastive Language-Image Pre-training) model to encode text queries to n-dimensional space.
 
     Attributes:
-        clip_data (list): A list of feature vectors representing the images.
+        clip_data (numpy.ndarray): A contiguous 2D float32 matrix of normalized feature vectors (one row per image),
+            the quantized vectors if the float32 matrix is not kept.
+        quantized (QuantizedEmbeddings): The feature vectors with reduced precision used for scoring (None for float32).
+        rescore_candidates (int): The number of best images re-scored with float32 vectors if quantized are used.
+        shards (numpy.ndarray): The bounds of row shards of the dataset which are scored in parallel.
+        executor (ThreadPoolExecutor): The pool of threads scoring the shards, shared by searchers of all snapshots
+            of the dataset (None if the shards are not used).
         combination (bool): A boolean flag indicating whether to combine the scores of the current and previous search
             queries. If True, the last search scores are added to the current scores.
             If False, only the current scores are used.
         logger (Logger): A Logger instance for logging search queries and results.
         showing (int): The number of top search results which are display.
-        last_search (dict): A dictionary to store the vectors of the last text search for each session.
+        sessions (SessionStore): The store of states of sessions (last search, sent images and their scores).
+        ann_index (IVFIndex): The approximate nearest-neighbour index (None for exact search).
+        video_ids (numpy.ndarray): The index of video of each image.
+        temporal_window (int): The number of following images searched by the second part of temporal query.
+        text_cache (TextEmbeddingCache): The cache of feature vectors of text queries.
         device: A string indicating whether to use CPU or GPU for running the CLIP model.
-        model: The pre-trained CLIP model.
+        model: The pre-trained CLIP model (None if other encoder is given).
+        encoder (TextEncoder): The encoder of text queries (batching concurrent queries).
     """
 
-    def __init__(self, clip_data, combination, logger, showing):
+    def __init__(self, clip_data, combination, logger, showing, ann_index=None, text_cache=None, video_ids=None,
+                 sessions=None, encoder=None, quantized=None):
         """
         Args:
-            clip_data (list): A list of feature vectors representing the images.
+            clip_data (numpy.ndarray): A 2D matrix of normalized feature vectors (one row per image), it can be None
+                if the quantized vectors are given.
             combination (bool): A boolean flag indicating whether to combine the scores of the current and previous
                 search queries.
             logger (Logger): A Logger instance for logging search queries and results.
             showing (int): The number of top search results which are display.
+            ann_index (IVFIndex): The approximate nearest-neighbour index (None for exact search).
+            text_cache (TextEmbeddingCache): The cache of feature vectors of text queries (by default in-memory cache
+                defined by settings).
+            video_ids (numpy.ndarray): The index of video of each image (by default all images are from one video).
+            sessions (SessionStore): The store of states of sessions (by default in-memory store defined by settings).
+            encoder (TextEncoder): The encoder of text queries (by default CLIP model is loaded).
+            quantized (QuantizedEmbeddings): The feature vectors with reduced precision used for scoring.
         """
-        self.clip_data = clip_data
+        # one contiguous float32 matrix, so scoring never has to copy the dataset
+        self.clip_data = quantized if clip_data is None else np.ascontiguousarray(clip_data, dtype=np.float32)
+        self.quantized = quantized
+        self.rescore_candidates = RESCORE_CANDIDATES
+        # numpy releases the GIL in matrix products and partitions, so the shards are scored by threads on all cores
+        self.shards = self._shards(len(self.clip_data))
+        self.executor = ThreadPoolExecutor(SCORING_SHARDS, thread_name_prefix="scoring") if SCORING_SHARDS > 1 else None
         self.combination = combination
-        self.last_search = {}  # vectors of last text search
+        self.sessions = sessions if sessions is not None else SessionStore(SESSION_MAX, SESSION_TTL, SESSION_MAX_BYTES)
         self.logger = logger
         self.showing = showing
-        self.last_sent = {}
-        self.last_scores = {}
+        self.ann_index = ann_index
+        self.video_ids = np.zeros(len(self.clip_data), dtype=np.int64) if video_ids is None else video_ids
+        self.temporal_window = TEMPORAL_WINDOW
+        self.text_cache = text_cache if text_cache is not None else TextEmbeddingCache(TEXT_CACHE_SIZE, TEXT_CACHE_TTL)
         self.alpha = 0.1
         self.index = 1
         # clip
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.model, preprocess = clip.load("ViT-B/32", device=self.device)
+        self.model, self.encoder = None, encoder
+        if encoder is None:
+            self.model, preprocess = clip.load("ViT-B/32", device=self.device)
+            self.encoder = TextEncoder(self.model, self.device, TEXT_BATCH_WINDOW, TEXT_BATCH_SIZE)
+
+    def with_data(self, clip_data, video_ids, quantized=None, ann_index=None):
+        """
+        Create the searcher of a new snapshot of the dataset (e.g. with newly ingested videos). It shares the model,
+        caches, sessions and logger with this searcher, so the snapshot can be swapped by replacing the reference
+        to the searcher (searches in progress finish with the previous snapshot).
+
+        Args:
+            clip_data (numpy.ndarray): A 2D matrix of normalized feature vectors (None if the quantized are given).
+            video_ids (numpy.ndarray): The index of video of each image.
+            quantized (QuantizedEmbeddings): The feature vectors with reduced precision used for scoring.
+            ann_index (IVFIndex): The approximate nearest-neighbour index (None for exact search).
+
+        Returns:
+            Searcher: The searcher of the new snapshot.
+        """
+        searcher = copy.copy(self)
+        searcher.clip_data = quantized if clip_data is None else np.ascontiguousarray(clip_data, dtype=np.float32)
+        searcher.quantized = quantized
+        searcher.ann_index = ann_index
+        searcher.video_ids = video_ids
+        searcher.shards = self._shards(len(searcher.clip_data))
+        return searcher
+
+    @staticmethod
+    def _shards(size):
+        # bounds of shards of the dataset (each shard has at least MIN_SHARD_ROWS images)
+        count = max(1, min(SCORING_SHARDS, size // MIN_SHARD_ROWS))
+        return np.linspace(0, size, count + 1).astype(np.int64)
 
     def result_score(self, features):
         """
         Calculate the similarity distance of the query feature vector to the CLIP data
-        (normalize feature vectors of images).
+        (normalize feature vectors of images). If the index is used, only candidates found by the index are scored
+        and other images get infinite distance. If the quantized vectors are used, the best images are re-scored
+        with float32 vectors (when they are kept) and other images get approximate distance.
 
         Args:
-            features (numpy.ndarray): A 2D array representing the normalize feature vector of the query.
+            features (numpy.ndarray): An array representing the normalize feature vector of the query.
 
         Returns:
             numpy.ndarray: A 1D array representing the similarity distance (from 0 to 2) of each image to the query.
         """
-        return np.concatenate([1 - (torch.cat(self.clip_data) @ features)], axis=None)
+        features = np.asarray(features, dtype=np.float32).ravel()
+        with metrics.timer("score"):
+            if self.ann_index is None:
+                scores = np.empty(len(self.clip_data), dtype=np.float32)
+                self.map_shards(lambda start, stop: self.score_rows(features, start, stop, scores))
+                if self.quantized is not None and self.rescore_candidates and self.clip_data is not self.quantized:
+                    scores = self.quantized.rescore(scores, features, self.clip_data, self.rescore_candidates)
+                return scores
+
+            candidates, distances = self.ann_index.search(features, INDEX_CANDIDATES, self.clip_data)
+            scores = np.full(len(self.clip_data), np.inf, dtype=np.float32)
+            scores[candidates] = distances
+            return scores
+
+    def score_rows(self, features, start, stop, scores):
+        """
+        Calculate the similarity distance of the query feature vector to one shard of the CLIP data.
+
+        Args:
+            features (numpy.ndarray): A 1D float32 normalize feature vector of the query.
+            start (int): The first image of the shard.
+            stop (int): The end of the shard (exclusive).
+            scores (numpy.ndarray): The distances of all images (the shard is written in place).
+        """
+        if self.quantized is not None:
+            scores[start:stop] = self.quantized.distances(features, start, stop)
+        else:
+            np.matmul(self.clip_data[start:stop], features, out=scores[start:stop])
+            np.subtract(1, scores[start:stop], out=scores[start:stop])
+
+    def map_shards(self, function):
+        """
+        Call the function for each shard of the dataset (in parallel if there are more shards).
+
+        Args:
+            function (function): The function called with the first image and the end of the shard.
+
+        Returns:
+            list: The results of the function in order of shards.
+        """
+        if self.executor is None or len(self.shards) == 2:
+            return [function(int(self.shards[0]), int(self.shards[-1]))]
+        return list(self.executor.map(function, self.shards[:-1].tolist(), self.shards[1:].tolist()))
+
+    def select_top(self, scores, k):
+        """
+        Select indices of the k lowest scores. The k best images of each shard are selected in parallel
+        and merged into the global top k.
+
+        Args:
+            scores (numpy.ndarray): A 1D array representing the similarity distance of each image.
+            k (int): The number of selected results.
+
+        Returns:
+            numpy.ndarray: A 1D array of indices of k best results sorted (in order) by the score.
+        """
+        if self.executor is None or len(self.shards) == 2 or len(scores) != self.shards[-1]:
+            return top_k(scores, k)
+        candidates = np.concatenate(self.map_shards(lambda start, stop: start + top_k(scores[start:stop], k)))
+        return candidates[top_k(scores[candidates], k)]
+
+    def encode_text(self, query):
+        """
+        Encode text query to the normalize feature vector using CLIP (repeated queries are taken from the cache).
+
+        Args:
+            query (str): The text query.
+
+        Returns:
+            numpy.ndarray: A 1D float32 array representing the normalize feature vector of the query.
+        """
+        return self.encode_texts([query])[0]
+
+    def encode_texts(self, queries):
+        """
+        Encode text queries to the normalize feature vectors using CLIP. Queries which are not cached are encoded
+        in one batch.
+
+        Args:
+            queries (list): A list of text queries.
+
+        Returns:
+            list: A list of 1D float32 arrays representing the normalize feature vectors of the queries.
+        """
+        text_features = [self.text_cache.get(query) for query in queries]
+        missing = list(dict.fromkeys(query for query, features in zip(queries, text_features) if features is None))
+        if missing:
+            with metrics.timer("encode"):
+                encoded = dict(zip(missing, self.encoder.encode(missing)))
+            for query, features in encoded.items():
+                self.text_cache.put(query, features)
+            text_features = [encoded[query] if features is None else features
+                             for query, features in zip(queries, text_features)]
+        return text_features
 
     def text_search(self, query, session, found, activity):
         """
@@ -70,27 +270,33 @@ class Searcher:
         Returns:
             list: A list of indices representing the top search results.
         """
+        start = time.perf_counter()
+
         # get normalize features of text query
-        with torch.no_grad():
-            text_features = self.model.encode_text(clip.tokenize([query]).to(self.device))
-        text_features /= np.linalg.norm(text_features)
+        text_features = self.encode_text(query)
 
         # get distance of vectors
-        scores = self.result_score(text_features.T)
-
-        new_scores = (scores + self.last_search[session]) if self.combination else scores
-        self.last_scores[session] = new_scores[:self.showing]
-        new_scores = list(np.argsort(new_scores))
-
-        # save score for next search
+        scores = self.result_score(text_features)
+
+        # the last search of the previous snapshot of the dataset (before new videos were ingested) is not combined
+        last_search = self.sessions.get(session).last_search
+        if last_search is not None and len(last_search) != len(scores):
+            last_search = None
+        new_scores = scores + last_search if self.combination and last_search is not None else scores
+        with metrics.timer("sort"):
+            top = self.select_top(new_scores, self.showing)
+
+        # save score for next search (allocated only if scores are combined)
+        self.sessions.update(session, last_scores=new_scores[top])
         if self.combination:
-            self.last_search[session] = scores
+            self.sessions.update(session, last_search=scores)
 
-        self.logger.log_text_query(query, new_scores, found, session, activity)
+        with metrics.timer("log"):
+            self.logger.log_text_query(query, new_scores, found, session, activity, time.perf_counter() - start)
 
-        return new_scores[:self.showing]
+        return top.tolist()
 
-    def temporal_search(self, query, session, found):
+    def temporal_search(self, query, session, found, activity=""):
         """
         Temporal search using CLIP data.
 
@@ -98,37 +304,63 @@ class Searcher:
             query (str): The text query.
             session (str): The unique session ID of the user. (used for logging)
             found (int): The index of the currently searching image. (used for logging)
+            activity (str): The activity from the user. (used for logging)
 
         Returns:
             list: A list of indices representing the top search results.
         """
-        query = query.split(">")
-        query1 = query[0]
-        query2 = query[1]
+        start = time.perf_counter()
 
-        # get normalize features of text query
-        with torch.no_grad():
-            text_features1 = self.model.encode_text(clip.tokenize([query1]).to(self.device))
-            text_features2 = self.model.encode_text(clip.tokenize([query2]).to(self.device))
-        text_features1 /= np.linalg.norm(text_features1)
-        text_features2 /= np.linalg.norm(text_features2)
+        query1, query2 = query.split(">")[:2]
+
+        # get normalize features of text query (both parts in one batch)
+        text_features1, text_features2 = self.encode_texts([query1, query2])
 
         # get distance of vectors
-        scores1 = self.result_score(text_features1.T)
-        scores2 = self.result_score(text_features2.T)
+        scores1 = self.result_score(text_features1)
+        scores2 = self.result_score(text_features2)
+
+        with metrics.timer("temporal"):
+            scores = scores1 * self.following_min(scores2)
+        with metrics.timer("sort"):
+            top = self.select_top(scores, self.showing)
+
+        # show each found image with the previous image and the window of following images (from the same video)
+        sequences = top[:, None] + np.arange(-1, self.temporal_window + 1)
+        in_dataset = (sequences >= 0) & (sequences < len(scores))
+        sequences = np.clip(sequences, 0, len(scores) - 1)
+        new_return = sequences[in_dataset & (self.video_ids[sequences] == self.video_ids[top][:, None])]
+
+        # without duplicates (in order of results)
+        _, first = np.unique(new_return, return_index=True)
+        new_return = new_return[np.sort(first)][:self.showing]
+
+        # save score for next search (allocated only if scores are combined)
+        self.sessions.update(session, last_scores=scores[new_return])
+        if self.combination:
+            self.sessions.update(session, last_search=scores)
 
-        scores = [a * (min(scores2[i + 1:i + 4]) if i < len(scores2) - 1 else 2) for i, a in enumerate(scores1)]
-        self.last_scores[session] = scores[:self.showing]
-        scores = list(np.argsort(scores))
+        with metrics.timer("log"):
+            self.logger.log_temporal_query(query, scores, found, session, activity, time.perf_counter() - start)
 
-        # save score for next search
-        if self.combination:
-            self.last_search[session] = scores
+        return new_return.tolist()
 
-        new_return = list(
-            [a for i in scores[:self.showing] for a in [i - 1, i, i + 1, i + 2, i + 3]])
+    def following_min(self, scores):
+        """
+        Calculate the minimum of scores of the following images (the window of temporal search) for each image.
+        Only images from the same video are taken into account.
+
+        Args:
+            scores (numpy.ndarray): A 1D array representing the similarity distance of each image.
 
-        return new_return[:self.showing]
+        Returns:
+            numpy.ndarray: A 1D array of minimal distance in the window following each image (2 for the empty window).
+        """
+        following = np.full(len(scores), 2, dtype=scores.dtype)
+        for offset in range(1, self.temporal_window + 1):
+            same_video = self.video_ids[offset:] == self.video_ids[:-offset]
+            np.minimum(following[:-offset], np.where(same_video, scores[offset:], 2), out=following[:-offset])
+        return following
 
     def image_search(self, image_query, found, session):
         """
@@ -142,64 +374,85 @@ class Searcher:
         Returns:
             list: A list of indices representing the top search results.
         """
+        start = time.perf_counter()
+
         # get features of image query
         image_query_index = int(image_query)
-        image_query_features = np.transpose(self.clip_data[image_query_index])
+        image_query_features = self.clip_data[image_query_index]
 
         scores = self.result_score(image_query_features)
-        self.last_scores[session] = scores[:self.showing]
-        scores = list(np.argsort(scores))
+        with metrics.timer("sort"):
+            top = self.select_top(scores, self.showing)
+        self.sessions.update(session, last_scores=scores[top])
 
-        self.logger.log_image_query(image_query, scores, found, session)
+        with metrics.timer("log"):
+            self.logger.log_image_query(image_query, scores, found, session, time.perf_counter() - start)
 
-        return scores[:self.showing]
+        return top.tolist()
 
-    def bayes_update(self, like_image, session):
+    def bayes_update(self, like_image, found, session):
         """
-        Bayes update using selected image.
+        Bayes update of the shown images using selected images (positive examples), other shown images are used
+        as negative examples. The update is computed for all shown images at once in log space.
 
         Args:
-            like_image (str): The index of the selected image.
+            like_image (str): The indexes of the selected images separated by "_".
+            found (int): The index of the currently searching image. (used for logging)
             session (str): The unique session ID of the user. (used for logging)
 
         Returns:
             list: A list of indices representing the top results after bayes update.
         """
-        # get features of image query
-        positive_image = int(like_image.split("_")[0])
-        positive_image2 = like_image.split("_")[1] if len(like_image.split("_")) > 1 else ""
-        dataset = [self.clip_data[i] for i in self.last_sent[session]]
-        negative_examples = [self.clip_data[i] for i in self.last_sent[session] if i != positive_image]
-        positive_examples = [self.clip_data[positive_image]]
-        if positive_image2 != "":
-            positive_examples.append(self.clip_data[int(positive_image2)])
-
-        negative = {str(i): np.concatenate([1 - (torch.cat(negative_examples) @ item.T)], axis=None) for
-                    i, item in enumerate(dataset)}
-        positive = {str(i): np.concatenate([1 - (torch.cat(positive_examples) @ item.T)], axis=None) for
-                    i, item in enumerate(dataset)}
-
-        scores = np.zeros(len(dataset))
-        if session in self.last_scores:
-            scores = [(1 + d) ** self.index for d in self.last_scores[session]]
-        for i in range(len(dataset)):
-            div_sum = 0
-            for neg in negative[str(i)]:
-                div_sum += math.exp(- neg / self.alpha)
-
-            for pos in positive[str(i)]:
-                PF = math.exp(- pos / self.alpha)
-                scores[i] *= (PF / (div_sum + PF))
-
-        scores = [self.last_sent[session][i] for i in list(np.argsort(scores))[::-1]]
-
-        return scores[:self.showing]
+        start = time.perf_counter()
+
+        # get features of shown images and examples (only selected images are known if the session was evicted)
+        state = self.sessions.get(session)
+        positive_ids = [int(i) for i in like_image.split("_") if i != ""]
+        displayed = np.asarray(positive_ids if state.last_sent is None else state.last_sent, dtype=np.int64)
+        dataset = self.clip_data[displayed]
+        negative_examples = self.clip_data[displayed[~np.isin(displayed, positive_ids)]]
+        positive_examples = self.clip_data[positive_ids]
+
+        # log of exp(- distance / alpha) for each pair (shown image x example)
+        negative = - (1 - dataset @ negative_examples.T) / self.alpha
+        positive = - (1 - dataset @ positive_examples.T) / self.alpha
+
+        # prior from the last search (uniform if it is not known for shown images)
+        scores = np.zeros(len(displayed))
+        prior = state.last_scores
+        if prior is not None and len(prior) == len(displayed):
+            scores = self.index * np.log1p(prior.astype(np.float64))
+        else:
+            prior = None
+
+        # multiply by PF / (sum of negative + PF) for each positive example
+        scores += (positive - np.logaddexp(logsumexp(negative, axis=1)[:, None], positive)).sum(axis=1)
+        metrics.observe("bayes", time.perf_counter() - start)
+
+        # higher score is better, logger ranks lower scores first
+        with metrics.timer("log"):
+            self.logger.log_bayes_update(like_image, displayed, -scores, found, session, time.perf_counter() - start)
+
+        # the priors are kept in order of the returned images (they become the shown images of the next update)
+        order = np.argsort(-scores, kind="stable")[:self.showing]
+        self.sessions.update(session, last_scores=None if prior is None else prior[order])
+        return displayed[order].tolist()
 
     def reset_last(self, session):
         """
-        Reset scores of last search for user of given session.
+        Reset scores of last search for user of given session (the next text search is not combined).
+
+        Args:
+            session (str): The unique session ID of the user.
+        """
+        self.sessions.update(session, last_search=None)
+
+    def set_last_sent(self, session, data):
+        """
+        Save images which were sent to user of given session (used by bayes update).
 
         Args:
             session (str): The unique session ID of the user.
+            data (list): A list of indices of sent images.
         """
-        self.last_search[session] = np.zeros(len(self.clip_data))
+        self.sessions.update(session, last_sent=np.asarray(data, dtype=np.int64))
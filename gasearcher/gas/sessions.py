@@ -0,0 +1,266 @@
+import io
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class SessionState:
+    """
+    State of searching of one user session.
+
+    Attributes:
+        last_search (numpy.ndarray): The scores of the last text search (None if there is nothing to combine with).
+        last_sent (numpy.ndarray): The indexes of images which were sent to the user last time.
+        last_scores (numpy.ndarray): The scores of images which were sent to the user last time.
+        accessed (float): The time of the last access to the state.
+    """
+
+    FIELDS = ('last_search', 'last_sent', 'last_scores')
+
+    def __init__(self, last_search=None, last_sent=None, last_scores=None):
+        """
+        Args:
+            last_search (numpy.ndarray): The scores of the last text search.
+            last_sent (numpy.ndarray): The indexes of images which were sent to the user last time.
+            last_scores (numpy.ndarray): The scores of images which were sent to the user last time.
+        """
+        self.last_search = last_search
+        self.last_sent = last_sent
+        self.last_scores = last_scores
+        self.accessed = time.monotonic()
+
+    @property
+    def nbytes(self):
+        """
+        Returns:
+            int: The number of bytes used by arrays of the state.
+        """
+        return sum(getattr(self, field).nbytes for field in self.FIELDS if getattr(self, field) is not None)
+
+
+class SessionStore:
+    """
+    Bounded store of states of user sessions. The least recently used sessions are evicted if there are too many
+    sessions or their states use too much memory, and sessions which were not used for a long time expire.
+
+    Attributes:
+        max_sessions (int): The maximal number of resident sessions.
+        ttl (float): The time (in seconds) after which unused session expires (None for no expiration).
+        max_bytes (int): The maximal number of bytes used by states of all sessions.
+        nbytes (int): The number of bytes currently used by states of all sessions.
+        evictions (int): The number of evicted or expired sessions.
+    """
+
+    def __init__(self, max_sessions=10000, ttl=None, max_bytes=None):
+        """
+        Args:
+            max_sessions (int): The maximal number of resident sessions.
+            ttl (float): The time (in seconds) after which unused session expires (None for no expiration).
+            max_bytes (int): The maximal number of bytes used by states of all sessions (None for no limit).
+        """
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.evictions = 0
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session):
+        """
+        Gets the state of the session (empty state if the session is not stored).
+
+        Args:
+            session (str): The unique session ID of the user.
+
+        Returns:
+            SessionState: The state of the session.
+        """
+        with self._lock:
+            self._expire()
+            state = self._states.get(session)
+            if state is None:
+                return SessionState()
+            state.accessed = time.monotonic()
+            self._states.move_to_end(session)
+            return state
+
+    def update(self, session, **values):
+        """
+        Updates given fields of the state of the session (arrays are stored as numpy arrays).
+
+        Args:
+            session (str): The unique session ID of the user.
+            **values: The new values of fields of SessionState.
+        """
+        with self._lock:
+            state = self._states.pop(session, None) or SessionState()
+            self.nbytes -= state.nbytes
+            for field, value in values.items():
+                setattr(state, field, None if value is None else np.asarray(value))
+            state.accessed = time.monotonic()
+            self._states[session] = state
+            self.nbytes += state.nbytes
+            self._expire()
+            self._evict()
+
+    def stats(self):
+        """
+        Returns:
+            dict: The number of resident sessions, used bytes and evictions.
+        """
+        with self._lock:
+            return {'sessions': len(self._states), 'bytes': self.nbytes, 'evictions': self.evictions}
+
+    def _remove_oldest(self):
+        _, state = self._states.popitem(last=False)
+        self.nbytes -= state.nbytes
+        self.evictions += 1
+
+    def _expire(self):
+        # sessions are ordered by the time of access
+        while self.ttl is not None and self._states and \
+                time.monotonic() - next(iter(self._states.values())).accessed > self.ttl:
+            self._remove_oldest()
+
+    def _evict(self):
+        # the current session (the last one) is never evicted
+        while len(self._states) > 1 and (len(self._states) > self.max_sessions or (
+                self.max_bytes is not None and self.nbytes > self.max_bytes)):
+            self._remove_oldest()
+
+
+class SqliteSessionStore:
+    """
+    Store of states of user sessions shared by all server processes (in SQLite database), so requests of one user
+    can be handled by any process. It has the same interface and limits as SessionStore and also stores values
+    which have to be same in all processes.
+
+    Attributes:
+        path (str): The path to the database file.
+        max_sessions (int): The maximal number of stored sessions.
+        ttl (float): The time (in seconds) after which unused session expires (None for no expiration).
+        max_bytes (int): The maximal number of bytes used by states of all sessions.
+        evictions (int): The number of sessions evicted or expired by this process.
+    """
+
+    def __init__(self, path, max_sessions=10000, ttl=None, max_bytes=None):
+        """
+        Args:
+            path (str): The path to the database file.
+            max_sessions (int): The maximal number of stored sessions.
+            ttl (float): The time (in seconds) after which unused session expires (None for no expiration).
+            max_bytes (int): The maximal number of bytes used by states of all sessions (None for no limit).
+        """
+        self.path = path
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.evictions = 0
+        self._local = threading.local()
+
+        with self._connection() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS sessions (session TEXT PRIMARY KEY, last_search BLOB, "
+                               "last_sent BLOB, last_scores BLOB, nbytes INTEGER, accessed REAL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS sessions_accessed ON sessions (accessed)")
+            connection.execute("CREATE TABLE IF NOT EXISTS shared (key TEXT PRIMARY KEY, value BLOB)")
+
+    def get(self, session):
+        """
+        Gets the state of the session (empty state if the session is not stored).
+
+        Args:
+            session (str): The unique session ID of the user.
+
+        Returns:
+            SessionState: The state of the session.
+        """
+        with self._connection() as connection:
+            self._expire(connection)
+            row = connection.execute("SELECT last_search, last_sent, last_scores FROM sessions WHERE session = ?",
+                                     (session,)).fetchone()
+            if row is None:
+                return SessionState()
+            connection.execute("UPDATE sessions SET accessed = ? WHERE session = ?", (time.time(), session))
+            return SessionState(*[_from_blob(value) for value in row])
+
+    def update(self, session, **values):
+        """
+        Updates given fields of the state of the session.
+
+        Args:
+            session (str): The unique session ID of the user.
+            **values: The new values of fields of SessionState.
+        """
+        with self._connection() as connection:
+            row = connection.execute("SELECT last_search, last_sent, last_scores FROM sessions WHERE session = ?",
+                                     (session,)).fetchone()
+            blobs = dict(zip(SessionState.FIELDS, row or (None, None, None)))
+            blobs.update({field: _to_blob(value) for field, value in values.items()})
+            connection.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?, ?)",
+                               (session, *[blobs[field] for field in SessionState.FIELDS],
+                                sum(len(blob) for blob in blobs.values() if blob is not None), time.time()))
+            self._expire(connection)
+            self._evict(connection, session)
+
+    def setdefault(self, key, value):
+        """
+        Gets the shared value, the given value is stored if the key is not defined yet (the first process wins).
+
+        Args:
+            key (str): The key of the value.
+            value: The value (convertible to numpy array).
+
+        Returns:
+            numpy.ndarray: The value stored for the key.
+        """
+        with self._connection() as connection:
+            connection.execute("INSERT OR IGNORE INTO shared VALUES (?, ?)", (key, _to_blob(value)))
+            return _from_blob(connection.execute("SELECT value FROM shared WHERE key = ?", (key,)).fetchone()[0])
+
+    def stats(self):
+        """
+        Returns:
+            dict: The number of stored sessions, used bytes and evictions (by this process).
+        """
+        with self._connection() as connection:
+            sessions, nbytes = connection.execute("SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM sessions").fetchone()
+        return {'sessions': sessions, 'bytes': nbytes, 'evictions': self.evictions}
+
+    def _connection(self):
+        # one connection for each thread, used as transaction context manager
+        if not hasattr(self._local, 'connection'):
+            self._local.connection = sqlite3.connect(self.path, timeout=30)
+            self._local.connection.execute("PRAGMA journal_mode=WAL")
+        return self._local.connection
+
+    def _expire(self, connection):
+        if self.ttl is not None:
+            self.evictions += connection.execute("DELETE FROM sessions WHERE accessed < ?",
+                                                 (time.time() - self.ttl,)).rowcount
+
+    def _evict(self, connection, current):
+        # the least recently used sessions over the limits are removed (the current session is never evicted)
+        while True:
+            sessions, nbytes = connection.execute("SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM sessions").fetchone()
+            within_bytes = self.max_bytes is None or nbytes <= self.max_bytes
+            if sessions <= 1 or (sessions <= self.max_sessions and within_bytes):
+                return
+            self.evictions += connection.execute(
+                "DELETE FROM sessions WHERE session = (SELECT session FROM sessions WHERE session != ? "
+                "ORDER BY accessed LIMIT 1)", (current,)).rowcount
+
+
+def _to_blob(value):
+    if value is None:
+        return None
+    buffer = io.BytesIO()
+    np.save(buffer, np.asarray(value), allow_pickle=False)
+    return buffer.getvalue()
+
+
+def _from_blob(blob):
+    return None if blob is None else np.load(io.BytesIO(blob), allow_pickle=False)
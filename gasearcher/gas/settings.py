@@ -5,17 +5,55 @@ from gasearcher.settings import STATICFILES_DIRS
 SEA_DATABASE = True
 COMBINATION = False  # if result should be combined with previous result
 USING_SOM = True
+FIRST_SCREENS = 1  # number of randomized first screens (generated from the same SOM) rotated between sessions
 PATH_DATA = os.path.join(STATICFILES_DIRS[0], "data/")  # get path to data
 SUR = 5  # surrounding of image in context
+TEMPORAL_WINDOW = 3  # number of following images (in the same video) searched by second part of temporal query
 IMAGES_ON_LINE = 5
 LINES = 50
 SHOWING = IMAGES_ON_LINE * LINES  # number of shown image in result
 NUMBER_OF_SEARCHED = 5
+WARM_UP = True  # if data and models are loaded in background when server starts (otherwise at the first request)
+ASYNC_VIEWS = False  # if asynchronous views are used (server has to be started by ASGI, e.g. uvicorn)
+SEARCH_WORKERS = 4  # number of threads which process requests of asynchronous views
+SEARCH_QUEUE_LIMIT = 64  # maximal number of waiting and processed requests of asynchronous views (others get 503)
+VOCABULARY_MAX_AGE = 86400  # time (in seconds) for which clients can cache names and probabilities of classes
+MULTIPROCESS = False  # if server runs in more processes (CLIP data and states of sessions are shared by all of them)
+SESSION_MAX = 10000  # maximal number of sessions whose state is kept in memory (least recently used are evicted)
+SESSION_TTL = 4 * 3600  # time in seconds after which state of unused session is removed (None = never)
+SESSION_MAX_BYTES = 1024 ** 3  # maximal memory in bytes used by states of all sessions (None = no limit)
+USING_INDEX = False  # approximate search by IVF index (built offline by `python -m gas.index`)
+INDEX_LISTS = 256  # number of lists (clusters) of the index
+INDEX_PROBE = 16  # number of lists searched for each query
+INDEX_SUBVECTORS = 0  # number of subvectors of product quantization of residuals (0 = no quantization)
+INDEX_CANDIDATES = 4 * SHOWING  # number of candidates scored exactly (images outside them are not ranked)
+EMBEDDING_PRECISION = "float32"  # precision of stored CLIP data: "float32", "float16" or "int8" (with scale per row)
+RESCORE_CANDIDATES = 1000  # number of best images re-scored with float32 data if precision is reduced (0 = off)
+SCORING_SHARDS = 1  # number of parts of the dataset scored in parallel threads (e.g. number of CPU cores, 1 = off)
+RELOAD_INTERVAL = 0  # time in seconds between checks of newly ingested videos (0 = data are never reloaded)
+TEXT_CACHE_SIZE = 1024  # number of cached vectors of text queries (0 = no cache)
+TEXT_CACHE_TTL = None  # time in seconds after which cached vector of text query expires (None = never)
+TEXT_CACHE_PERSIST = False  # if the cache of text queries should be saved to file at exit and loaded at start
+TEXT_BATCH_WINDOW = 0.005  # time in seconds for which concurrent text queries are collected to one batch (0 = off)
+TEXT_BATCH_SIZE = 32  # maximal number of text queries encoded in one batch
+
+METRICS_MEMORY = False  # if the memory used by the process is reported by the metrics endpoint
+LOG_FORMAT = "csv"  # format of query logs: "csv", "json" (newline-delimited JSON with timing) or "both"
+LOG_QUEUE_SIZE = 10000  # maximal number of log lines waiting for writing (other lines are dropped)
+LOG_BATCH_SIZE = 256  # maximal number of log lines written at once
+LOG_FLUSH_INTERVAL = 1.0  # maximal time in seconds for which log lines wait before they are written
 
 PATH_CLIP = "clip" # name of folder with preprocessed CLIP data
+PATH_CLIP_PACKED = "clip.bin" # name of the packed file with preprocessed CLIP data (used instead of folder if exists)
+PATH_INDEX = "clip_index.npz" # name of the file with approximate nearest-neighbour index
+PATH_TEXT_CACHE = "text_cache.npz" # name of the file with persisted cache of text queries
+PATH_SESSIONS = "sessions.sqlite3" # name of the database with states of sessions shared by server processes
 PATH_NOUNLIST = "nounlist.txt" # name of the nounlist
 PATH_CLASSES = "result.csv" # name of the file with classification of images
+PATH_CLASSES_MATRIX = "result.npy" # name of the binary file with classification of images (created from PATH_CLASSES)
+PATH_SOM = "som.npz" # name of the file with cached SOM of class labels and first screens
 PATH_SELECTION = "" # name of the file with indexes of images which should be used for searching (can be empty)
 PATH_ENDS = "videos_end.txt" # name of the file with indexes of images which represents ends of each video
 PATH_LOG = "log.csv" # name of the log file for text queries
-PATH_LOG_SIMILARITY = "log_similarity.csv" # name of the log file for image queries
\ No newline at end of file
+PATH_LOG_SIMILARITY = "log_similarity.csv" # name of the log file for image queries
+PATH_LOG_JSON = "log.jsonl" # name of the structured log file for all queries (if LOG_FORMAT is "json" or "both")
\ No newline at end of file
@@ -1,14 +1,31 @@
+import atexit
+import json
+import os
 import random
-from unittest.mock import Mock
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import Mock, patch
 
 import clip
 import numpy as np
 import torch
 from PIL import Image
-from django.test import TestCase
-from gas.models import size_dataset
-from gas.searcher import Searcher
+from django.test import RequestFactory, TestCase
+from gas.classes import ClassTable, class_matrix, convert_classes_csv, read_class_matrix
+from gas.data import LoaderDatabase
+from gas.embeddings import append_packed, read_packed, write_packed
+from gas.encoder import TextEmbeddingCache, TextEncoder
+from gas.files import atomic_write
+from gas.index import IVFIndex, recall_at_k
+from gas.logger import Logger, LogWriter
+from gas.metrics import Metrics
+from gas.models import Resources, resources
+from gas.quantization import QuantizedEmbeddings, recall_report
+from gas.searcher import Searcher, logsumexp, top_k
+from gas.sessions import SessionStore, SqliteSessionStore
 from gas.settings import PATH_DATA
+from gas.views import ready
 
 
 class SearcherTest(TestCase):
@@ -30,6 +47,95 @@ class SearcherTest(TestCase):
 
         self.assertListEqual(expected_result, result.tolist())
 
+    def test_following_min(self):
+        """
+        Test that the window of temporal search does not cross the end of video.
+
+        Raises:
+            AssertionError: If the test fails.
+        """
+        searcher = Searcher(np.eye(6), False, self.logger, 2, video_ids=np.array([0, 0, 0, 1, 1, 1]))
+        searcher.temporal_window = 2
+        scores = np.array([0.5, 0.4, 0.3, 0.1, 0.9, 0.8])
+
+        self.assertListEqual([0.3, 0.3, 2, 0.8, 0.8, 2], searcher.following_min(scores).tolist())
+
+    def test_temporal_search(self):
+        """
+        Test that temporal search shows each found image with the previous and following images of the same video
+        (without duplicates, in order of results) and logs the query.
+
+        Raises:
+            AssertionError: If the test fails.
+        """
+        searcher = Searcher(np.eye(8), False, self.logger, 4, video_ids=np.array([0, 0, 0, 0, 1, 1, 1, 1]),
+                            encoder=Mock())
+        searcher.temporal_window = 1
+        searcher.encode_texts = Mock(return_value=[np.array([0.5, 0, 0, 0.9, 0.8, 0.7, 0, 0]),
+                                                   np.array([0, 0, 0, 0, 0, 0.9, 0.9, 0])])
+
+        # found images 4, 5, 3 and 0 (image 3 is the last and image 4 the first image of a video)
+        self.assertListEqual([4, 5, 6, 2], searcher.temporal_search("a > b", "session", 0))
+        self.logger.log_temporal_query.assert_called_once()
+        self.assertEqual(4, len(searcher.sessions.get("session").last_scores))
+
+    def test_with_data(self):
+        """
+        Test that the searcher of a new snapshot searches in new images and does not combine the last search
+        of the previous snapshot.
+
+        Raises:
+            AssertionError: If the test fails.
+        """
+        searcher = Searcher(np.eye(3), True, self.logger, 2, encoder=Mock())
+        searcher.encode_text = Mock(return_value=np.array([0, 0, 0, 1], dtype=np.float32))
+        searcher.sessions.update("session", last_search=np.zeros(3))
+        new_searcher = searcher.with_data(np.eye(4), np.zeros(4, dtype=np.int64))
+
+        self.assertEqual(3, len(searcher.clip_data))
+        self.assertIs(searcher.sessions, new_searcher.sessions)
+        self.assertListEqual([3], new_searcher.text_search("query", "session", 0, "")[:1])
+
+    def test_bayes_update(self):
+        """
+        Test that the Bayes update ranks shown images as the direct computation (with several positive examples
+        and without the prior) and that the second update uses the priors of the images shown after the first one.
+
+        Raises:
+            AssertionError: If the test fails.
+        """
+        data = np.random.default_rng(0).random((10, 4))
+        data /= np.linalg.norm(data, axis=1, keepdims=True)
+        searcher = Searcher(data, False, self.logger, 4, encoder=Mock())
+
+        def expected(shown, priors, positives):
+            # product of PF / (sum of negative + PF) for each positive example, multiplied by the prior
+            negatives = [i for i in shown if i not in positives]
+            scores = []
+            for i, prior in zip(shown, priors):
+                score = (1 + prior) ** searcher.index
+                for j in positives:
+                    pf = np.exp(- (1 - data[i] @ data[j]) / searcher.alpha)
+                    score *= pf / (sum(np.exp(- (1 - data[i] @ data[n]) / searcher.alpha) for n in negatives) + pf)
+                scores.append(score)
+            return [shown[i] for i in np.argsort(scores, kind="stable")[::-1][:4]]
+
+        # without the prior of the shown images
+        searcher.set_last_sent("session", [1, 3, 5, 7, 9])
+        self.assertListEqual(expected([1, 3, 5, 7, 9], [0] * 5, [3, 7]), searcher.bayes_update("3_7", 0, "session"))
+
+        # two updates in a row after a search
+        shown, priors = [2, 4, 6, 8], np.array([0.1, 0.9, 0.4, 0.7])
+        searcher.set_last_sent("session", shown)
+        searcher.sessions.update("session", last_scores=priors)
+        first = searcher.bayes_update("4_6", 0, "session")
+        self.assertListEqual(expected(shown, priors, [4, 6]), first)
+
+        searcher.set_last_sent("session", first)
+        first_priors = [priors[shown.index(i)] for i in first]
+        self.assertListEqual(first_priors, searcher.sessions.get("session").last_scores.tolist())
+        self.assertListEqual(expected(first, first_priors, [8]), searcher.bayes_update("8", 0, "session"))
+
     def valid_data_test(self):
         """
         Test the validity of the given image and its associated vector.
@@ -37,7 +143,7 @@ class SearcherTest(TestCase):
         Raises:
             AssertionError: If the test fails.
         """
-        image_id = random.randint(1, size_dataset)
+        image_id = random.randint(1, resources.size_dataset)
         image_path = PATH_DATA + "photos//" + str(image_id).zfill(5) + ".jpg"
         vector_path = PATH_DATA + "clip//" + str(image_id).zfill(5) + ".pt"
 
@@ -53,3 +159,440 @@ class SearcherTest(TestCase):
 
         # Check that the computed image features match the expected features
         self.assertEqual(image_features, torch.load(vector_path))
+
+
+class TopKTest(TestCase):
+    def test_top_k(self):
+        """
+        Test that partial selection returns the same results as the full sort.
+
+        Raises:
+            AssertionError: If the test fails.
+        """
+        scores = np.random.rand(1000)
+
+        self.assertListEqual(list(np.argsort(scores)[:20]), top_k(scores, 20).tolist())
+        self.assertEqual(3, len(top_k(scores[:3], 20)))
+
+    @patch("gas.searcher.SCORING_SHARDS", 4)
+    @patch("gas.searcher.MIN_SHARD_ROWS", 100)
+    def test_sharded(self):
+        """
+        Test that scoring and selection in parallel shards give the same results as one shard and that searchers
+        of new snapshots share the pool of threads.
+
+        Raises:
+            AssertionError: If the test fails.
+        """
+        data = np.random.rand(1000, 8).astype(np.float32)
+        data /= np.linalg.norm(data, axis=1, keepdims=True)
+        searcher = Searcher(data, False, Mock(), 20, encoder=Mock())
+        scores = searcher.result_score(data[0])
+
+        self.assertEqual(5, len(searcher.shards))
+        np.testing.assert_allclose(1 - data @ data[0], scores, atol=1e-6)
+        self.assertListEqual(top_k(scores, 20).tolist(), searcher.select_top(scores, 20).tolist())
+
+        new_searcher = searcher.with_data(data[:200], np.zeros(200, dtype=np.int64))
+        self.assertEqual(3, len(new_searcher.shards))
+        self.assertIs(searcher.executor, new_searcher.executor)
+
+
+class ClassTableTest(TestCase):
+    def test_classes(self):
+        """
+        Test that the table built from the matrix of top classes returns the same classes and top classes
+        as the dictionary of classes.
+
+        Raises:
+            AssertionError: If the test fails.
+        """
+        class_data = {i: [i % 7, 10 + i % 3] for i in range(50) if i != 5}
+        table = ClassTable.from_matrix(class_matrix([i + 1 for i in class_data], list(class_data.values()), 50), 20)
+        ids = [5, 3, 49, 60, 3] + list(range(20, 40))
+
+        self.assertListEqual([class_data.get(i, []) for i in ids], table.classes_of(ids))
+        self.assertListEqual([10, 11, 12], table.top_classes(ids, 3, 5))
+
+    def test_convert_csv(self):
+        """
+        Test that the binary class table contains the same classes as the CSV file.
+
+        Raises:
+            AssertionError: If the test fails.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            csv_path = os.path.join(directory, "result.csv")
+            with open(csv_path, "w") as f:
+                f.write("id;top\n00001;[6239, 4331, 4328]\n00003;[2, 1]\n")
+            convert_classes_csv(csv_path, os.path.join(directory, "result.npy"))
+            matrix = read_class_matrix(os.path.join(directory, "result.npy"))
+
+        self.assertEqual(np.int16, matrix.dtype)
+        self.assertListEqual([[6239, 4331, 4328], [-1, -1, -1], [2, 1, -1]], matrix.tolist())
+        self.assertListEqual([[6239, 4331, 4328], [], [2, 1]], ClassTable.from_matrix(matrix).classes_of([0, 1, 2]))
+
+
+class LogSumExpTest(TestCase):
+    def test_logsumexp(self):
+        """
+        Test that stable log-sum-exp equals to the direct computation and handles large and empty inputs.
+
+        Raises:
+            AssertionError: If the test fails.
+        """
+        values = np.random.rand(5, 7)
+
+        self.assertTrue(np.allclose(np.log(np.exp(values).sum(axis=1)), logsumexp(values, axis=1)))
+        self.assertTrue(np.all(np.isfinite(logsumexp(values * 1e4, axis=1))))
+        self.assertListEqual([-np.inf] * 5, logsumexp(np.empty((5, 0)), axis=1).tolist())
+
+
+class LoggerTest(TestCase):
+    def test_get_rank(self):
+        """
+        Test that rank computed from scores equals to the position in the sorted result (ties ranked optimistically).
+
+        Raises:
+            AssertionError: If the test fails.
+        """
+        scores = np.random.rand(1000)
+        index = random.randint(0, 999)
+
+        self.assertEqual(list(np.argsort(scores)).index(index) + 1, Logger.get_rank(scores, index))
+        self.assertEqual(2, Logger.get_rank(np.array([0.5, 0.1, 0.5, 0.7]), 2))
+
+    def test_writer(self):
+        """
+        Test that the background writer writes all lines in order of writing.
+
+        Raises:
+            AssertionError: If the test fails.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            writer = LogWriter(batch_size=7, interval=0.01)
+            for i in range(20):
+                writer.write(os.path.join(directory, f"log{i % 2}.csv"), f"{i}\n")
+            writer.close()
+
+            with open(os.path.join(directory, "log0.csv")) as f:
+                self.assertEqual("".join(f"{i}\n" for i in range(0, 20, 2)), f.read())
+        self.assertDictEqual({'queued': 0, 'written': 20, 'dropped': 0}, writer.stats())
+
+    def test_json_log(self):
+        """
+        Test that the structured log contains one JSON object with rank and timing per query.
+
+        Raises:
+            AssertionError: If the test fails.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            writer = LogWriter(interval=0.01)
+            logger = Logger(directory + "/", {}, [3], False, writer, "json")
+            logger.log_text_query("dog", np.arange(10.0), 0, "session", "", 0.5)
+            writer.close()
+
+            with open(logger.path_log_json) as f:
+                row = json.loads(f.read())
+        self.assertEqual(("text", "dog", 3, "session", 4, 0.5),
+                         (row['action'], row['query'], row['target'], row['session'], row['rank'], row['elapsed']))
+        self.assertFalse(os.path.exists(logger.path_log))
+
+    def test_temporal_log(self):
+        """
+        Test that the temporal query is written only to the structured log (with its type of action).
+
+        Raises:
+            AssertionError: If the test fails.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            writer = LogWriter(interval=0.01)
+            logger = Logger(directory + "/", {}, [3], False, writer, "both")
+            logger.log_temporal_query("dog > cat", np.arange(10.0)[::-1], 0, "session", "", 0.5)
+            writer.close()
+
+            with open(logger.path_log_json) as f:
+                row = json.loads(f.read())
+            self.assertFalse(os.path.exists(logger.path_log))
+        self.assertEqual(("temporal", "dog > cat", 7), (row['action'], row['query'], row['rank']))
+
+
+class MetricsTest(TestCase):
+    def test_render(self):
+        """
+        Test that durations of stages are exported as cumulative histograms and collected for the current request
+        and that statistics of components are exported.
+
+        Raises:
+            AssertionError: If the test fails.
+        """
+        metrics = Metrics(buckets=(0.1, 1.0))
+        with metrics.request("search"):
+            metrics.observe("score", 0.05)
+            metrics.observe("score", 0.5)
+            self.assertDictEqual({'score': 0.55}, metrics.current())
+
+        text = metrics.render()
+        self.assertIn('gas_stage_seconds_bucket{stage="score",le="0.1"} 1', text)
+        self.assertIn('gas_stage_seconds_bucket{stage="score",le="+Inf"} 2', text)
+        self.assertIn('gas_stage_seconds_count{stage="view_search"} 1', text)
+
+        text = metrics.render({'sessions': SessionStore(10).stats(), 'log': {'queued': 0, 'written': 4, 'dropped': 1}})
+        self.assertIn('gas_sessions_sessions 0', text)
+        self.assertIn('# TYPE gas_log_dropped_total counter\ngas_log_dropped_total 1', text)
+
+
+class PackedEmbeddingsTest(TestCase):
+    def test_write_read(self):
+        """
+        Test that vectors and ids written (and appended) to the packed file are mapped back unchanged.
+
+        Raises:
+            AssertionError: If the test fails.
+        """
+        vectors = np.random.rand(10, 4).astype(np.float32)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "clip.bin")
+            write_packed(path, vectors, np.arange(5, 15))
+            read_vectors, ids = read_packed(path)
+
+            self.assertTrue(np.array_equal(vectors, read_vectors))
+            self.assertListEqual(list(range(5, 15)), ids.tolist())
+            del read_vectors, ids
+
+            append_packed(path, vectors[:2], [15, 16])
+            read_vectors, ids = read_packed(path)
+            self.assertTrue(np.array_equal(np.concatenate([vectors, vectors[:2]]), read_vectors))
+            self.assertListEqual(list(range(5, 17)), ids.tolist())
+            del read_vectors, ids
+
+    def test_loaded_ids(self):
+        """
+        Test that the packed file is loaded only if row i contains the image i + 1.
+
+        Raises:
+            AssertionError: If the test fails.
+        """
+        vectors = np.random.rand(3, 4).astype(np.float32)
+        with tempfile.TemporaryDirectory() as directory:
+            loader = LoaderDatabase(directory + "/", False)
+            write_packed(loader.path_clip_packed, vectors, [1, 2, 3])
+            self.assertTrue(np.array_equal(vectors, loader.get_clip_data()))
+
+            write_packed(loader.path_clip_packed, vectors, [1, 3, 2])
+            with self.assertRaises(ValueError):
+                loader.get_clip_data()
+
+
+class AtomicWriteTest(TestCase):
+    def test_atomic_write(self):
+        """
+        Test that the file is replaced only when the whole content is written and no temporary file is left.
+
+        Raises:
+            AssertionError: If the test fails.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "data.txt")
+            with atomic_write(path, "w") as f:
+                f.write("first")
+            with self.assertRaises(RuntimeError):
+                with atomic_write(path, "w") as f:
+                    f.write("second")
+                    raise RuntimeError()
+            with open(path) as f:
+                self.assertEqual("first", f.read())
+            self.assertListEqual(["data.txt"], os.listdir(directory))
+
+
+class IVFIndexTest(TestCase):
+    def test_recall(self):
+        """
+        Test that the index finds the exact results when all lists are probed and that quantized index is close.
+
+        Raises:
+            AssertionError: If the test fails.
+        """
+        data = np.random.rand(500, 8).astype(np.float32) - 0.5
+        data /= np.linalg.norm(data, axis=1, keepdims=True)
+
+        self.assertAlmostEqual(1.0, recall_at_k(IVFIndex.build(data, 10, n_probe=10), data, data[:20], 10))
+        self.assertGreater(recall_at_k(IVFIndex.build(data, 10, 4, n_probe=10), data, data[:20], 10), 0.5)
+
+
+class QuantizedEmbeddingsTest(TestCase):
+    def test_quantized_search(self):
+        """
+        Test that quantized vectors use less memory, their distances are close to exact distances and re-scoring
+        makes the best results exact.
+
+        Raises:
+            AssertionError: If the test fails.
+        """
+        data = np.random.rand(500, 16).astype(np.float32) - 0.5
+        data /= np.linalg.norm(data, axis=1, keepdims=True)
+
+        for precision, ratio in (("float16", 2), ("int8", 3)):
+            quantized = QuantizedEmbeddings.quantize(data, precision)
+            self.assertLessEqual(quantized.nbytes * ratio, data.nbytes)
+            np.testing.assert_allclose(1 - data @ data[0], quantized.distances(data[0]), atol=0.02)
+            np.testing.assert_allclose(data[:3], quantized[:3], atol=0.01)
+
+            searcher = Searcher(data, False, Mock(), 2, encoder=Mock(), quantized=quantized)
+            scores = searcher.result_score(data[0])
+            best = top_k(scores, 10)
+            np.testing.assert_allclose(1 - data[best] @ data[0], scores[best], atol=1e-6)
+
+        recall = {(row['precision'], row['rescore']): row['recall'] for row in recall_report(data, data[:20], 10)}
+        self.assertAlmostEqual(1.0, recall[('int8', 1000)])
+        self.assertGreater(recall[('int8', 0)], 0.8)
+
+
+class TextEncoderTest(TestCase):
+    @staticmethod
+    def tokenize(queries):
+        # token of each query is its length (the tokenizer fails for too long queries as CLIP does)
+        if any(len(query) > 77 for query in queries):
+            raise RuntimeError("Input is too long for context length 77")
+        return torch.tensor([[len(query)] for query in queries])
+
+    def test_batching(self):
+        """
+        Test that concurrent queries are encoded in one batch, each caller gets vectors of its own queries
+        and a too long query fails only the request which contains it.
+
+        Raises:
+            AssertionError: If the test fails.
+        """
+        model = Mock()
+        model.encode_text.side_effect = lambda tokens: torch.cat([tokens.float(), torch.ones_like(tokens)], dim=1)
+        encoder = TextEncoder(model, "cpu", window=0.5)
+        requests = [["a dog"], ["a black cat", "a fish"], ["a" * 100]]
+
+        with patch("gas.encoder.clip.tokenize", self.tokenize):
+            with ThreadPoolExecutor(len(requests)) as executor:
+                futures = [executor.submit(encoder.encode, queries) for queries in requests]
+
+            for queries, future in zip(requests[:2], futures):
+                expected = np.array([[len(query), 1] for query in queries], dtype=np.float32)
+                np.testing.assert_allclose(expected / np.linalg.norm(expected, axis=1, keepdims=True),
+                                           future.result(), rtol=1e-6)
+            self.assertRaises(RuntimeError, futures[2].result)
+        self.assertEqual(1, model.encode_text.call_count)
+
+
+class TextEmbeddingCacheTest(TestCase):
+    def test_lru(self):
+        """
+        Test that normalized queries share the cached vector and the least recently used query is removed.
+
+        Raises:
+            AssertionError: If the test fails.
+        """
+        cache = TextEmbeddingCache(2)
+        cache.put("a dog", np.ones(3))
+        cache.put("a cat", np.zeros(3))
+
+        self.assertIsNotNone(cache.get(" A  Dog"))
+        cache.put("a fish", np.ones(3))
+        self.assertIsNone(cache.get("a cat"))
+        self.assertDictEqual({'size': 2, 'hits': 1, 'misses': 1}, cache.stats())
+
+
+    def test_persistence(self):
+        """
+        Test that the saved cache is loaded again and an unreadable file is loaded as an empty cache.
+
+        Raises:
+            AssertionError: If the test fails.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "text_cache.npz")
+            cache = TextEmbeddingCache(2, path=path)
+            atexit.unregister(cache.save)
+            cache.put("a dog", np.ones(3))
+            cache.save()
+            loaded = TextEmbeddingCache(2, path=path)
+            atexit.unregister(loaded.save)
+            self.assertListEqual([1, 1, 1], loaded.get("a dog").tolist())
+
+            with open(path, "r+b") as f:
+                f.truncate(os.path.getsize(path) // 2)
+            damaged = TextEmbeddingCache(2, path=path)
+            atexit.unregister(damaged.save)
+            self.assertDictEqual({'size': 0, 'hits': 0, 'misses': 0}, damaged.stats())
+
+
+class SessionStoreTest(TestCase):
+    def test_eviction(self):
+        """
+        Test that the least recently used sessions are evicted when the limits of sessions or memory are exceeded.
+
+        Raises:
+            AssertionError: If the test fails.
+        """
+        store = SessionStore(max_sessions=2, max_bytes=900)
+        store.update("a", last_sent=np.arange(10))
+        store.update("b", last_sent=np.arange(10))
+        store.get("a")
+        store.update("c", last_sent=np.arange(10))
+
+        self.assertIsNone(store.get("b").last_sent)
+        self.assertListEqual(list(range(10)), store.get("a").last_sent.tolist())
+
+        store.update("d", last_search=np.zeros(110))
+        self.assertDictEqual({'sessions': 1, 'bytes': 880, 'evictions': 3}, store.stats())
+
+    def test_shared_store(self):
+        """
+        Test that the state of session and shared values are visible to another instance of shared store.
+
+        Raises:
+            AssertionError: If the test fails.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "sessions.sqlite3")
+            SqliteSessionStore(path).update("a", last_sent=np.arange(3))
+            self.assertListEqual([5, 6], SqliteSessionStore(path).setdefault("targets", [5, 6]).tolist())
+
+            store = SqliteSessionStore(path)
+            self.assertListEqual([0, 1, 2], store.get("a").last_sent.tolist())
+            self.assertListEqual([5, 6], store.setdefault("targets", [1, 2]).tolist())
+
+
+class ResourcesTest(TestCase):
+    @patch.object(Resources, "_warm_up")
+    def test_after_fork(self, warm_up):
+        """
+        Test that the process forked during the warm-up discards components and the lock of the parent and starts
+        its own warm-up.
+
+        Raises:
+            AssertionError: If the test fails.
+        """
+        res = Resources()
+        res.warm_up().join()
+        res.__dict__['loader'] = Mock()
+        holder = threading.Thread(target=res._lock.acquire)
+        holder.start()
+        holder.join()
+        lock = res._lock
+
+        res._after_fork()
+        res._warming.join()
+        self.assertNotIn('loader', res.__dict__)
+        self.assertIsNot(lock, res._lock)
+        self.assertEqual(2, warm_up.call_count)
+
+    @patch.object(resources, "warm_up")
+    def test_ready_starts_loading(self, warm_up):
+        """
+        Test that the readiness probe starts loading of the process which is not loaded.
+
+        Raises:
+            AssertionError: If the test fails.
+        """
+        response = ready(RequestFactory().get("/ready"))
+
+        self.assertEqual(503, response.status_code)
+        warm_up.assert_called_once()
@@ -1,9 +1,15 @@
 from django.urls import path
 
 from . import views
+from .settings import ASYNC_VIEWS
 
 urlpatterns = [
-    path("", views.start, name="start"),
-    path("search", views.search, name="search"),
-    path("end", views.end, name="end"),
+    path("", views.start_async if ASYNC_VIEWS else views.start, name="start"),
+    path("search", views.search_async if ASYNC_VIEWS else views.search, name="search"),
+    path("end", views.end_async if ASYNC_VIEWS else views.end, name="end"),
+    path("api/search", views.api_search_async if ASYNC_VIEWS else views.api_search, name="api_search"),
+    path("api/vocabulary", views.api_vocabulary, name="api_vocabulary"),
+    path("health", views.health, name="health"),
+    path("ready", views.ready, name="ready"),
+    path("metrics", views.metrics_view, name="metrics"),
 ]
@@ -1,12 +1,53 @@
+import asyncio
+import functools
+import hashlib
+import json
 import secrets
-from collections import Counter
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse
 from django.shortcuts import redirect, render
 from django.template import loader
-from gas.models import targets, class_data, classes, class_pr, first_show, searcher
-from gas.settings import USING_SOM, SHOWING
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import etag, require_GET
+from gas.metrics import metrics
+from gas.models import resources
+from gas.settings import USING_SOM, SHOWING, SEARCH_WORKERS, SEARCH_QUEUE_LIMIT, VOCABULARY_MAX_AGE
+
+# executor of async views (encoding, scoring and rendering run outside of the event loop)
+executor = ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix="search")
+pending_requests = 0
+
+
+def timed(view):
+    """
+    Measures the duration of the view and collects durations of stages of the request (exported by metrics view).
+
+    Args:
+        view (function): The view.
+
+    Returns:
+        function: The measured view.
+    """
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        with metrics.request(view.__name__):
+            return view(request, *args, **kwargs)
+    return wrapper
+
+
+@functools.lru_cache(maxsize=None)
+def get_vocabulary():
+    """
+    Serializes names and probabilities of classes (only once, they never change while the server runs).
+
+    Returns:
+        tuple: The JSON with names and probabilities of classes and its ETag.
+    """
+    vocabulary = json.dumps({'classes': resources.classes, 'percent': resources.class_pr})
+    return vocabulary, hashlib.sha1(vocabulary.encode()).hexdigest()
 
 
 def prepare_data(request, data, find):
@@ -24,24 +65,25 @@ def prepare_data(request, data, find):
     template = loader.get_template('index.html')
 
     # get classes of current shown result
-    data_to_display = {str(i): ([] if i not in class_data else class_data[i]) for i in data}
+    classes_of_data = resources.class_table.classes_of(data)
+    data_to_display = {str(i): values for i, values in zip(np.asarray(data).tolist(), classes_of_data)}
     # get top classes contains in result
-    top_classes = [word for word, word_count in
-                   Counter(np.concatenate([a for a in data_to_display.values()], axis=None)).most_common(5) if
-                   word_count > 5]
+    top_classes = resources.class_table.top_classes(data, 5, 5)
 
     sending_data = {
         'photos': data,
         'list_photo': data_to_display,
-        'percent': class_pr,
-        'classes': ','.join(classes),
+        'percent': resources.class_pr,
+        'classes': ','.join(resources.classes),
         'top_classes': top_classes[::-1],
         'find_id': str(find)
     }
 
-    return HttpResponse(template.render(sending_data, request))
+    with metrics.timer("render"):
+        return HttpResponse(template.render(sending_data, request))
 
 
+@timed
 def search(request):
     """
     Performs a search query and send the result to the template.
@@ -57,29 +99,103 @@ def search(request):
 
     # load index of currently searching image from cookies
     found = int(request.COOKIES.get('index')) if request.COOKIES.get('index') is not None else 0
-    if found >= len(targets):  # control of end
+    if found >= len(resources.targets):  # control of end
         return redirect('/end')
-    data = first_show if USING_SOM else np.arange(1, SHOWING + 1)
+
+    data, _ = run_search(request, found)
+
+    return prepare_data(request, data, resources.targets[found])
+
+
+def run_search(request, found):
+    """
+    Performs the search given by the parameters of the request (shared by HTML and JSON views).
+
+    Args:
+        request (HttpRequest): The HTTP request containing information about the current request.
+        found (int): The index of currently searching image.
+
+    Returns:
+        tuple: A list of indices of result images and a list of their scores (None if the scores are not known,
+            e.g. for the first screen or bayes update).
+    """
+    session = request.session['session_id']
+    searcher, first_show = resources.searcher, resources.first_show
+    data = first_show[zlib.crc32(session.encode()) % len(first_show)] if USING_SOM else np.arange(1, SHOWING + 1)
+    scored = False
 
     if request.GET.get('query'):
         if ">" in request.GET['query']:
-            data = searcher.temporal_search(request.GET['query'], request.session['session_id'], found)
+            data = searcher.temporal_search(request.GET['query'], session, found,
+                                            (request.COOKIES.get('activity') or ' ')[:-1])
         else:
-            data = searcher.text_search(request.GET['query'], request.session['session_id'], found,
-                                        request.COOKIES.get('activity')[:-1])
+            data = searcher.text_search(request.GET['query'], session, found,
+                                        (request.COOKIES.get('activity') or ' ')[:-1])
+        scored = True
     else:
         # reset save search if user use any other method than text search
-        searcher.reset_last(request.session['session_id'])
+        searcher.reset_last(session)
         if request.GET.get('sim_id'):
-            data = searcher.image_search(request.GET['sim_id'], found, request.session['session_id'])
+            data = searcher.image_search(request.GET['sim_id'], found, session)
+            scored = True
         if request.GET.get('b_id'):
-            data = searcher.bayes_update(request.GET['b_id'], request.session['session_id'])
+            data = searcher.bayes_update(request.GET['b_id'], found, session)
+            scored = False
+
+    searcher.set_last_sent(session, data)
+
+    scores = searcher.sessions.get(session).last_scores if scored else None
+    return data, None if scores is None else scores.tolist()
 
-    searcher.last_sent[request.session['session_id']] = data
 
-    return prepare_data(request, data, targets[found])
+@require_GET
+@timed
+def api_search(request):
+    """
+    Performs a search query and returns only the result as JSON (ids of images, their scores and ids of their
+    classes). Names and probabilities of classes are served once by api_vocabulary.
 
+    Args:
+        request (HttpRequest): The HTTP request containing information about the current request.
 
+    Returns:
+        JsonResponse: The result of the search.
+    """
+    if not request.session.get('session_id'):
+        return JsonResponse({'error': "Session is not started."}, status=403)
+
+    found = int(request.COOKIES.get('index')) if request.COOKIES.get('index') is not None else 0
+    if found >= len(resources.targets):  # control of end
+        return JsonResponse({'end': True})
+
+    data, scores = run_search(request, found)
+    ids = np.asarray(data).tolist()
+
+    return JsonResponse({
+        'ids': ids,
+        'scores': scores,
+        'classes': resources.class_table.classes_of(ids),
+        'find_id': int(resources.targets[found]),
+    })
+
+
+@require_GET
+@cache_control(public=True, max_age=VOCABULARY_MAX_AGE)
+@etag(lambda request: get_vocabulary()[1])
+def api_vocabulary(request):
+    """
+    Returns names and probabilities of classes as JSON (cacheable, they do not change between requests).
+
+    Args:
+        request (HttpRequest): The HTTP request.
+
+    Returns:
+        HttpResponse: The JSON with names of classes and probability of each class.
+    """
+    return HttpResponse(get_vocabulary()[0], content_type="application/json")
+
+
+@timed
 def start(request):
     """
     Sets the session id and renders the start.html template (welcome page).
@@ -92,10 +208,11 @@ def start(request):
     """
     # "login" - setting session id
     request.session['session_id'] = secrets.token_urlsafe(6)
-    searcher.reset_last(request.session['session_id'])
+    resources.searcher.reset_last(request.session['session_id'])
     return render(request, 'start.html')
 
 
+@timed
 def end(request):
     """
     Renders the end.html template (final page).
@@ -107,3 +224,126 @@ def end(request):
         HttpResponse: The HTTP response containing the data to be displayed in the template.
     """
     return render(request, 'end.html')
+
+
+def health(request):
+    """
+    Reports that the server process is alive (it does not wait for loading of data).
+
+    Args:
+        request (HttpRequest): The HTTP request.
+
+    Returns:
+        JsonResponse: The status of the process.
+    """
+    return JsonResponse({'status': "ok"})
+
+
+def ready(request):
+    """
+    Reports which components (data and models) are loaded, so traffic can be routed only to warm server processes.
+    Loading is started if it has not started yet (e.g. `WARM_UP` is not set and the process did not get any search),
+    so the process becomes ready without traffic.
+
+    Args:
+        request (HttpRequest): The HTTP request.
+
+    Returns:
+        JsonResponse: The status of loading (status 503 until all components are loaded).
+    """
+    resources.warm_up()
+    status = resources.status()
+    return JsonResponse(status, status=200 if status['ready'] else 503)
+
+
+def metrics_view(request):
+    """
+    Exports durations of stages of the search pipeline, statistics of sessions, of the cache of text queries
+    and of the log (and memory of the process) in Prometheus text format.
+
+    Args:
+        request (HttpRequest): The HTTP request.
+
+    Returns:
+        HttpResponse: The metrics of this server process.
+    """
+    return HttpResponse(metrics.render(resources.stats()), content_type="text/plain; version=0.0.4")
+
+
+async def run_in_executor(view, request):
+    """
+    Runs the synchronous view in the bounded executor. Requests over the limit of queue are refused and the request
+    is cancelled (if it has not started yet) when the client disconnects.
+
+    Args:
+        view (function): The synchronous view.
+        request (HttpRequest): The HTTP request.
+
+    Returns:
+        HttpResponse: The HTTP response of the view (status 503 if the queue is full).
+    """
+    global pending_requests
+    if pending_requests >= SEARCH_QUEUE_LIMIT:
+        return HttpResponse("Server is busy, try it again later.", status=503)
+
+    pending_requests += 1
+    future = executor.submit(view, request)
+    try:
+        return await asyncio.wrap_future(future)
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    finally:
+        pending_requests -= 1
+
+
+async def search_async(request):
+    """
+    Asynchronous variant of search view.
+
+    Args:
+        request (HttpRequest): The HTTP request containing information about the current request.
+
+    Returns:
+        Union[HttpResponse, HttpResponseRedirect]: The HTTP response.
+    """
+    return await run_in_executor(search, request)
+
+
+async def start_async(request):
+    """
+    Asynchronous variant of start view.
+
+    Args:
+        request (HttpRequest): The HTTP request.
+
+    Returns:
+        HttpResponse: The HTTP response containing the data to be displayed in the template.
+    """
+    return await run_in_executor(start, request)
+
+
+async def api_search_async(request):
+    """
+    Asynchronous variant of api_search view.
+
+    Args:
+        request (HttpRequest): The HTTP request containing information about the current request.
+
+    Returns:
+        JsonResponse: The result of the search.
+    """
+    return await run_in_executor(api_search, request)
+
+
+async def end_async(request):
+    """
+    Asynchronous variant of end view.
+
+    Args:
+        request (HttpRequest): The HTTP request.
+
+    Returns:
+        HttpResponse: The HTTP response containing the data to be displayed in the template.
+    """
+    return await run_in_executor(end, request)
@@ -7,10 +7,54 @@ For more information on this file, see
 https://docs.djangoproject.com/en/4.0/howto/deployment/asgi/
 """
 
+import asyncio
 import os
 
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'gasearcher.settings')
 
-application = get_asgi_application()
+
+class CancelOnDisconnect:
+    """
+    ASGI middleware which cancels handling of HTTP request when the client disconnects (so the asynchronous views
+    can drop searches which nobody waits for).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        # messages are passed to the application through the queue, so disconnect can be noticed at any time
+        messages = asyncio.Queue()
+        handler = asyncio.ensure_future(self.app(scope, messages.get, send))
+
+        async def watch():
+            while True:
+                message = await receive()
+                await messages.put(message)
+                if message['type'] == 'http.disconnect':
+                    handler.cancel()
+                    return
+
+        watcher = asyncio.ensure_future(watch())
+        try:
+            await handler
+        except asyncio.CancelledError:
+            if not watcher.done():
+                raise
+        finally:
+            watcher.cancel()
+
+
+application = CancelOnDisconnect(get_asgi_application())
+
+# start loading of data and models, so the server is ready before the first search
+from gas.models import resources  # noqa: E402
+from gas.settings import WARM_UP  # noqa: E402
+
+if WARM_UP:
+    resources.warm_up()
@@ -14,3 +14,10 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'gasearcher.settings')
 
 application = get_wsgi_application()
+
+# start loading of data and models, so the server is ready before the first search
+from gas.models import resources  # noqa: E402
+from gas.settings import WARM_UP  # noqa: E402
+
+if WARM_UP:
+    resources.warm_up()
@@ -1,4 +1,3 @@
-import csv
 import os
 import sys
 
@@ -78,37 +77,25 @@ class Evaluator:
             is_sea (bool): Whether the sea dataset is used.
             with_limited (bool): Defines whether models should be evaluated for a limited dataset.
         """
-        query_count = 0
-        previous_id = -1
-        previous_session_id = ""
-        same_count = 0
-
-        with open(log_path) as csv_file:
-            csv_reader = csv.reader(csv_file, delimiter=';')
-            next(csv_reader)  # skip header
-
-            for row in csv_reader:
-                current_id = int(row[1])
-                current_session = row[2]
-
-                # change of user or searched image
-                if previous_id != current_id or previous_session_id != current_session:
-                    query_count += 1
-                    same_count = 1
-                    self.last_search[current_session] = np.zeros(len(self.clip_data))
-                    self.min_search[current_session] = np.full(len(self.clip_data), 2)
-                    self.multi_search[current_session] = np.ones(len(self.clip_data))
-                else:
-                    same_count += 1
-
-                if same_count <= reform_count:
-                    self.get_data_from_text_search(row[0], current_session, current_id, same_count == 2,
-                                                   with_som, is_sea, with_limited)
-
-                previous_id = current_id
-                previous_session_id = current_session
-
-        print("Total search: ", query_count)
+        log = read_log(log_path, skip_header=True)
+        if 'action' in log:
+            log = log[log['action'] == "text"]
+
+        # order of query within the search of one image by one user (the search changes with user or searched image)
+        changed = (log['target'] != log['target'].shift()) | (log['session'] != log['session'].shift())
+        same_count = (log.groupby(changed.cumsum()).cumcount() + 1).tolist()
+
+        for row, count, first in zip(log[['query', 'target', 'session']].itertuples(index=False), same_count, changed):
+            if first:
+                self.last_search[row.session] = np.zeros(len(self.clip_data))
+                self.min_search[row.session] = np.full(len(self.clip_data), 2)
+                self.multi_search[row.session] = np.ones(len(self.clip_data))
+
+            if count <= reform_count:
+                self.get_data_from_text_search(row.query, row.session, int(row.target), count == 2,
+                                               with_som, is_sea, with_limited)
+
+        print("Total search: ", int(changed.sum()))
 
     def get_data_from_text_search(self, query, session, found, is_second, with_som, is_sea, with_limited):
         """
@@ -220,28 +207,20 @@ class Evaluator:
             A list containing the ranks for second query, ranks for first query, and difference values
             extracted from the log file.
         """
-        position_of_rank = 5 if use_surrounding else 3
-        ranks1 = []
-        ranks2 = []
-        with open(log_path) as csv_file:
-            csv_reader = csv.reader(csv_file, delimiter=';')
-            line = 0
+        log = read_log(log_path)
+        rank = log[5 if use_surrounding else 'rank'].astype(np.int64)
+        previous_rank = rank.shift(fill_value=0)
 
-            previous_row = {}
+        # pairs of consecutive queries of the same user searching the same image
+        selected = (log['target'] == log['target'].shift()) & (log['session'] == log['session'].shift())
+        if filter_undefined:
+            selected &= rank > 0
+        if filter_findable:
+            selected &= previous_rank > self.showing
 
-            for row in csv_reader:
-                if line > 0 and row[1] == previous_row[1] and row[2] == previous_row[2]:
-                    if ((filter_undefined and int(row[position_of_rank]) > 0) or not filter_undefined) and (
-                            (filter_findable and int(
-                                int(previous_row[position_of_rank]) > self.showing)) or not filter_findable):
-                        ranks1.append(int(previous_row[position_of_rank]) if int(previous_row[position_of_rank]) > 0 else len(self.clip_data))
-                        ranks2.append(
-                            int(row[position_of_rank]) if int(row[position_of_rank]) > 0 else len(self.clip_data))
-
-                previous_row = row
-                line += 1
-
-        return [ranks2, ranks1]
+        ranks1 = np.where(previous_rank > 0, previous_rank, len(self.clip_data))[selected.to_numpy()]
+        ranks2 = np.where(rank > 0, rank, len(self.clip_data))[selected.to_numpy()]
+        return [ranks2.tolist(), ranks1.tolist()]
 
     def get_data_for_graph(self, input_path, first_col_name, with_limited, filter_undefined, filter_findable,
                            use_surrounding):
@@ -389,6 +368,26 @@ class Evaluator:
         plt.savefig(output_file)
 
 
+def read_log(log_path, skip_header=False):
+    """
+    Loads the whole log at once. Newline-delimited JSON logs (.jsonl) are loaded with their named columns,
+    columns of semicolon-separated logs are named by position (query, target, session, rank, then numbers).
+
+    Args:
+        log_path (str): Path to the log file.
+        skip_header (bool): Whether the first line of semicolon-separated log is a header.
+
+    Returns:
+        pandas.DataFrame: The log with one row per query.
+    """
+    if log_path.endswith(".jsonl"):
+        return pd.read_json(log_path, lines=True, dtype={'query': str, 'session': str})
+
+    log = pd.read_csv(log_path, sep=';', header=None, skiprows=1 if skip_header else 0,
+                      dtype={0: str, 2: str}, keep_default_na=False)
+    return log.rename(columns={0: 'query', 1: 'target', 2: 'session', 3: 'rank'})
+
+
 class Logger:
     def __init__(self, showing, same_video, result_path):
         """
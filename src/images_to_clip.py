@@ -1,26 +1,63 @@
+import os
+import sys
+
 import clip
 import numpy as np
 import torch
 from PIL import Image
 
+# the packed format is shared with the searcher
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "gasearcher"))
+from gas.embeddings import write_packed
+
 device = "cuda" if torch.cuda.is_available() else "cpu"
 model, preprocess = clip.load("ViT-B/32", device=device)
 
 
-def get_vector_from_photo(photo_path, photo_name, result_path):
+def get_vector(photo_path):
     """
-    Extracts a feature vector from an input photo and saves it to a .pt file.
+    Extracts a normalized feature vector from an input photo.
 
     Args:
         photo_path (str): The file path of the input photo.
-        photo_name (str): The name of the input photo.
-        result_path (str): The directory path where the output .pt file will be saved.
+
+    Returns:
+        torch.Tensor: The normalized feature vector of the photo (with shape 1 x dim).
     """
     image = preprocess(Image.open(photo_path)).unsqueeze(0).to(device)
 
     with torch.no_grad():
         image_feat = model.encode_image(image)
-        image_feat = image_feat / np.linalg.norm(image_feat)
-        torch.save(image_feat, result_path + f"//{photo_name}.pt")
+        return image_feat / np.linalg.norm(image_feat)
+
+
+def get_vector_from_photo(photo_path, photo_name, result_path):
+    """
+    Extracts a feature vector from an input photo and saves it to a .pt file.
+
+    Args:
+        photo_path (str): The file path of the input photo.
+        photo_name (str): The name of the input photo.
+        result_path (str): The directory path where the output .pt file will be saved.
+    """
+    torch.save(get_vector(photo_path), result_path + f"//{photo_name}.pt")
 
     print(photo_name)
+
+
+def get_vectors_to_packed(photos_path, photo_names, result_file, dtype=np.float32):
+    """
+    Extracts feature vectors from input photos and saves all of them to one packed file.
+
+    Args:
+        photos_path (str): The directory path of the input photos.
+        photo_names (list): The names of the input photos (without extension), the names must be numbers.
+        result_file (str): The path of the output packed file.
+        dtype: The type used for storing of the vectors (float32 or float16).
+    """
+    vectors = []
+    for photo_name in photo_names:
+        vectors.append(get_vector(photos_path + photo_name + ".jpg").float().cpu().numpy())
+        print(photo_name)
+
+    write_packed(result_file, np.concatenate(vectors), [int(photo_name) for photo_name in photo_names], dtype)
@@ -0,0 +1,237 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+import torch
+
+from images_to_clip import get_vector
+from parse_video import get_comm
+
+# the data files are shared with the searcher
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "gasearcher"))
+from gas.classes import write_class_matrix
+from gas.data import LoaderDatabase
+from gas.embeddings import append_packed, convert_clip_folder, read_packed
+from gas.files import atomic_write
+
+MANIFEST = "videos_manifest.txt"  # name of the file with already processed videos
+
+
+def read_manifest(manifest_path):
+    """
+    Reads already processed videos. Each line contains the path of video and the first image of the video
+    (the image is missing for videos marked as processed by --mark-processed).
+
+    Args:
+        manifest_path (str): The path to the manifest.
+
+    Returns:
+        dict: The first image of each video (None if it is not known) by the path of video (relative to the folder
+            with videos).
+    """
+    if not os.path.exists(manifest_path):
+        return {}
+    entries = {}
+    with open(manifest_path) as f:
+        for line in f:
+            video, separator, start = line.strip().rpartition(";")
+            if separator:
+                entries[video] = int(start)
+            elif start:
+                entries[start] = None
+    return entries
+
+
+def find_new_videos(videos_path, processed):
+    """
+    Recursively finds videos which are not processed yet.
+
+    Args:
+        videos_path (str): The path to the directory containing the videos.
+        processed (set): The paths of already processed videos.
+
+    Returns:
+        list: The sorted paths of new videos (relative to the folder with videos).
+    """
+    videos = []
+    for directory, _, filenames in os.walk(videos_path):
+        for filename in filenames:
+            if filename.lower().endswith(".mp4"):
+                videos.append(os.path.relpath(os.path.join(directory, filename), videos_path).replace(os.sep, "/"))
+    return sorted(video for video in videos if video not in processed)
+
+
+def extract_frames(video_path, frames_path):
+    """
+    Extracts frames of one video to the empty directory (by the same FFmpeg command as parse_video).
+
+    Args:
+        video_path (str): The path to the video.
+        frames_path (str): The path to the directory where the frames will be saved.
+
+    Returns:
+        list: The paths of extracted frames in order of the video.
+    """
+    frames_path = os.path.join(frames_path, "")
+    if os.system(get_comm(video_path, frames_path, 1)) == 1:
+        os.system(get_comm(video_path, frames_path, 1, False))
+    frames = [fn for fn in os.listdir(frames_path) if fn.endswith(".jpg")]
+    return [frames_path + fn for fn in sorted(frames, key=lambda fn: int(fn[:-4]))]
+
+
+def ingest(videos_path, result_path, nounlist_path, photos_path=None, is_sea_database=False):
+    """
+    Adds videos which are not in the manifest to the processed dataset. Only frames of new videos are extracted
+    and embedded, they are numbered after the last image of the dataset. The classes, ends of videos, manifest
+    and CLIP data are staged in temporary files which then replace the previous ones. The packed file with CLIP
+    data is replaced last, so a running searcher (with `RELOAD_INTERVAL` set) switches to the new snapshot only
+    when all files are complete, and files of an interrupted ingestion are recovered by the next run.
+    The manifest has to exist for a dataset which is not empty (see --mark-processed).
+
+    Args:
+        videos_path (str): The path to the directory containing the videos.
+        result_path (str): The path to the directory with the processed dataset.
+        nounlist_path (str): The path to the nounlist features obtained from the CLIP model (nounlist.pt).
+        photos_path (str): The path to the directory with frames (by default photos in result_path).
+        is_sea_database (bool): Whether the dataset uses names of files of the sea database.
+
+    Returns:
+        int: The number of added images.
+    """
+    loader = LoaderDatabase(result_path, is_sea_database)
+    photos_path = photos_path or result_path + "photos/"
+    os.makedirs(photos_path, exist_ok=True)
+    manifest_path = result_path + MANIFEST
+
+    if not os.path.exists(loader.path_clip_packed):
+        convert_clip_folder(loader.path_clip, loader.path_clip_packed)
+    size_dataset = len(read_packed(loader.path_clip_packed)[0])
+    if size_dataset and not os.path.exists(manifest_path):
+        raise ValueError(f"{manifest_path} does not exist, so all videos would be added again to the dataset "
+                         f"of {size_dataset} images. Run the script with --mark-processed first.")
+    recover(loader, manifest_path, size_dataset)
+    class_data = loader.get_photos_classes()
+    if len(class_data) != size_dataset:
+        raise ValueError(f"Classes of {len(class_data)} images do not match CLIP data of {size_dataset} images.")
+
+    videos = find_new_videos(videos_path, set(read_manifest(manifest_path)))
+    if not videos:
+        print("no new videos")
+        return 0
+
+    # extract and embed frames of new videos (numbered from the end of the dataset)
+    starts, vectors = {}, []
+    for video in videos:
+        with tempfile.TemporaryDirectory() as frames_path:
+            frames = extract_frames(os.path.join(videos_path, video), frames_path)
+            if not frames:
+                print(f"no frames extracted from {video}")
+                continue
+            starts[video] = size_dataset + len(vectors) + 1
+            for frame in frames:
+                photo = photos_path + f"{size_dataset + len(vectors) + 1:05d}.jpg"
+                shutil.move(frame, photo)
+                vectors.append(get_vector(photo).float().cpu().numpy())
+        print(f"{video}: {len(frames)} frames")
+    if not vectors:
+        return 0
+
+    vectors = np.concatenate(vectors)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    ids = np.arange(size_dataset + 1, size_dataset + len(vectors) + 1)
+
+    # top classes of new images (the same number of classes as the images of the dataset)
+    text_features = torch.load(nounlist_path, map_location="cpu").float()
+    top = (torch.from_numpy(vectors) @ text_features.T).topk(class_data.shape[1]).indices.numpy()
+
+    # all files are written to temporary files first and the packed file is replaced last (it defines which images
+    # are ingested, files of an interrupted ingestion are recovered by the next run)
+    staged = [
+        (_stage_lines(loader.path_classes, [f"{image_id:05d};{row.tolist()}" for image_id, row in zip(ids, top)]),
+         loader.path_classes),
+        (_stage_lines(loader.path_ends, starts.values()), loader.path_ends),
+        (_stage_lines(manifest_path, [f"{video};{start}" for video, start in starts.items()]), manifest_path),
+    ]
+    class_data = np.concatenate([class_data, top.astype(class_data.dtype)])
+    write_class_matrix(loader.path_classes_matrix + ".ingest", class_data)
+    staged.append((loader.path_classes_matrix + ".ingest", loader.path_classes_matrix))
+    append_packed(loader.path_clip_packed, vectors, ids, loader.path_clip_packed + ".ingest")
+    staged.append((loader.path_clip_packed + ".ingest", loader.path_clip_packed))
+
+    for staged_path, path in staged:
+        os.replace(staged_path, path)
+    return len(vectors)
+
+
+def recover(loader, manifest_path, size_dataset):
+    """
+    Removes images of an interrupted ingestion from the classes, ends of videos and the manifest. The packed file
+    is replaced last, so images which are not in it were not ingested.
+
+    Args:
+        loader (LoaderDatabase): The loader of the dataset.
+        manifest_path (str): The path to the manifest.
+        size_dataset (int): The number of images in the packed file.
+    """
+    class_data = loader.get_photos_classes()
+    if len(class_data) > size_dataset:
+        write_class_matrix(loader.path_classes_matrix, class_data[:size_dataset])
+
+    with open(loader.path_classes) as f:
+        header, *rows = f.read().splitlines()
+    kept = [row for row in rows if row.strip() and int(row.split(";")[0]) <= size_dataset]
+    _replace_lines(loader.path_classes, [header] + kept, len(rows) + 1)
+
+    if os.path.exists(loader.path_ends):
+        with open(loader.path_ends) as f:
+            ends = [line.strip() for line in f if line.strip()]
+        _replace_lines(loader.path_ends, [end for end in ends if int(end) <= size_dataset], len(ends))
+
+    entries = read_manifest(manifest_path)
+    kept = {video: start for video, start in entries.items() if start is None or start <= size_dataset}
+    _replace_lines(manifest_path, [video if start is None else f"{video};{start}" for video, start in kept.items()],
+                   len(entries))
+
+
+def _replace_lines(path, lines, count):
+    # the file is rewritten only if some of its count lines were removed
+    if len(lines) < count:
+        print(f"removed {count - len(lines)} lines of interrupted ingestion from {path}")
+        os.replace(_stage_lines(path, lines, False), path)
+
+
+def _stage_lines(path, lines, append=True):
+    # writes the lines (after the current content of the file if append is set) to a temporary file
+    previous = ""
+    if append and os.path.exists(path):
+        with open(path) as f:
+            previous = f.read()
+    if previous and not previous.endswith("\n"):
+        previous += "\n"
+    staged_path = path + ".ingest"
+    with atomic_write(staged_path, "w") as f:
+        f.write(previous + "".join(f"{line}\n" for line in lines))
+    return staged_path
+
+
+if __name__ == "__main__":
+    # usage: python ingest.py ./data/videos ./data/ ./data/nounlist.pt
+    parser = argparse.ArgumentParser(description="Adds new videos to the processed dataset.")
+    parser.add_argument("videos", help="directory with videos")
+    parser.add_argument("result", help="directory with the processed dataset")
+    parser.add_argument("nounlist", help="nounlist features obtained from CLIP (nounlist.pt)")
+    parser.add_argument("--photos", help="directory with frames (photos in the dataset directory by default)")
+    parser.add_argument("--sea", action="store_true", help="the dataset uses names of files of the sea database")
+    parser.add_argument("--mark-processed", action="store_true",
+                        help="only write all current videos to the manifest (for datasets processed before)")
+    args = parser.parse_args()
+
+    result = os.path.join(args.result, "")
+    if args.mark_processed:
+        manifest = result + MANIFEST
+        os.replace(_stage_lines(manifest, find_new_videos(args.videos, set(read_manifest(manifest)))), manifest)
+    else:
+        print(f"added {ingest(args.videos, result, args.nounlist, args.photos, args.sea)} images")
@@ -3,7 +3,7 @@ import os
 import clip
 import torch
 
-from images_to_clip import get_vector_from_photo
+from images_to_clip import get_vector_from_photo, get_vectors_to_packed
 from parse_video import parse_video
 from top_classes import classify_images
 
@@ -25,6 +25,7 @@ class Preprocessor:
         self.vectors_path = result_path + "clip//"
         if not os.path.exists(self.vectors_path):
             os.makedirs(self.vectors_path)
+        self.packed_path = result_path + "clip.bin"
 
     def parse_videos(self, enable_logging, log_path="videos.txt"):
         """
@@ -40,10 +41,18 @@ class Preprocessor:
             else:
                 parse_video(self.videos_path + "//" + filename, self.photos_path, enable_logging, log_path)
 
-    def images_to_vectors(self):
+    def images_to_vectors(self, packed=False):
         """
         Converts images (.jpg) to vectors using CLIP.
+
+        Args:
+            packed (bool): Whether all vectors are saved to one packed file instead of one .pt file per image.
         """
+        if packed:
+            get_vectors_to_packed(self.photos_path, sorted(photo[:-4] for photo in os.listdir(self.photos_path)),
+                                  self.packed_path)
+            return
+
         for photo in os.listdir(self.photos_path):
             get_vector_from_photo(self.photos_path + photo, photo[:-4], self.vectors_path)
 
@@ -79,7 +88,9 @@ class Preprocessor:
             new_nounlist_name (str): The name of file to which will be writen nounlist with frequency of each class.
         """
         self.nounlist_to_vectors(nounlist_path, self.result_path + "nounlist.pt")
-        classify_images(self.vectors_path, self.result_path + "nounlist.pt", result_file)
+        vectors_path = self.packed_path if os.path.exists(self.packed_path) else self.vectors_path
+        classify_images(vectors_path, self.result_path + "nounlist.pt", result_file,
+                        matrix_file=os.path.splitext(result_file)[0] + ".npy")
         self.get_class_pr(nounlist_path, result_file, new_nounlist_name)
 
     @staticmethod
@@ -123,17 +134,18 @@ class Preprocessor:
             os.rename(images_path + file, images_path + name_format.format(i) + ".jpg")
             i += 1
 
-    def preprocess_dataset(self, nounlist_path):
+    def preprocess_dataset(self, nounlist_path, packed=False):
         """
         Preprocesses a dataset by parsing the videos, extracting frames, converting them to vectors,
         classifying the vectors, and saving the results to a file.
 
         Args:
             nounlist_path (str): The path to the noun list file used for classification.
+            packed (bool): Whether the vectors are saved to one packed file instead of one .pt file per image.
         """
         self.parse_videos(True, self.result_path + "videos_end.txt")
         self.rename_images(self.photos_path)
-        self.images_to_vectors()
+        self.images_to_vectors(packed)
         self.classify_images(nounlist_path, self.result_path + "result.csv", self.result_path + "nounlist.txt")
 
 
@@ -0,0 +1,168 @@
+import argparse
+import http.cookies
+import json
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+
+def load_sessions(log_paths):
+    """
+    Reconstructs sessions from query logs of the searcher. Newline-delimited JSON logs (.jsonl) are ordered by time,
+    rows of semicolon-separated logs (log.csv with text queries and log_similarity.csv with image queries and bayes
+    updates) keep their order in each file.
+
+    CSV logs do not contain the type of action, so rows of log_similarity.csv with more selected images ("12_34")
+    are replayed as bayes updates and other rows as image searches, even if they are bayes updates with one selected
+    image (sent as "b_id=12" by the user interface). Temporal queries ("A > B") are written only to JSON logs,
+    so they are replayed (as queries, which the server recognizes by ">") only from JSON logs. Use JSON logs
+    (LOG_FORMAT "json" or "both") for exact replay.
+
+    Args:
+        log_paths (list): Paths to the log files.
+
+    Returns:
+        list: A list of sessions, each of them is a list of actions (dictionaries with parameters of /search,
+            the index of the searched image and the time of the action in seconds, None if it is not known).
+    """
+    logs = []
+    for log_path in log_paths:
+        if log_path.endswith(".jsonl"):
+            log = pd.read_json(log_path, lines=True, dtype={'query': str, 'session': str})
+            logs.append(log[['action', 'query', 'target', 'session', 'timestamp']])
+        else:
+            log = pd.read_csv(log_path, sep=';', header=None, usecols=[0, 1, 2], names=['query', 'target', 'session'],
+                              dtype={'query': str, 'session': str}, keep_default_na=False)
+            log['action'] = "text" if "similarity" not in log_path else np.where(
+                log['query'].str.contains("_"), "bayes", "image")
+            log['timestamp'] = np.nan
+            logs.append(log)
+    log = pd.concat(logs, ignore_index=True)
+    log = log.sort_values('timestamp', kind='stable') if log['timestamp'].notna().all() else log
+
+    parameters = {'text': 'query', 'temporal': 'query', 'image': 'sim_id', 'bayes': 'b_id'}
+    sessions = []
+    for _, rows in log[log['action'].isin(list(parameters))].groupby('session', sort=False):
+        # the user searches the targets one after another, so the index of the searched image (sent in the cookie
+        # "index") is the number of previous changes of the target in the session
+        indexes = (rows['target'] != rows['target'].shift()).cumsum() - 1
+        sessions.append([{'params': {parameters[row.action]: row.query}, 'index': int(index),
+                          'time': None if pd.isna(row.timestamp) else float(row.timestamp)}
+                         for row, index in zip(rows.itertuples(index=False), indexes)])
+    return sessions
+
+
+def replay_session(url, session, delay, speed, timeout):
+    """
+    Replays one session with its own cookies (the session is started by the start page).
+
+    Args:
+        url (str): The URL of the searcher.
+        session (list): The actions of the session.
+        delay (float): The pause (in seconds) between actions if their times are not used.
+        speed (float): The speed of replay of recorded times (0 means that the times are not used).
+        timeout (float): The timeout (in seconds) of one request.
+
+    Returns:
+        list: The latency (in seconds) and the error (None for success) of each request.
+    """
+    cookies = {}
+    results = [request(url, cookies, timeout)]
+
+    previous = None
+    for action in session:
+        if speed > 0 and action['time'] is not None and previous is not None:
+            time.sleep(max(0.0, (action['time'] - previous) / speed))
+        elif delay > 0:
+            time.sleep(delay)
+        previous = action['time']
+        cookies['index'] = str(action['index'])
+        results.append(request(url + "search?" + urllib.parse.urlencode(action['params']), cookies, timeout))
+    return results
+
+
+def request(url, cookies, timeout):
+    """
+    Sends GET request with the cookies of the session and measures its latency.
+
+    Args:
+        url (str): The requested URL.
+        cookies (dict): The cookies of the session (updated by cookies set by the response).
+        timeout (float): The timeout (in seconds) of the request.
+
+    Returns:
+        tuple: The latency (in seconds) and the error (None for success).
+    """
+    headers = {'Cookie': "; ".join(f"{name}={value}" for name, value in cookies.items())} if cookies else {}
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=timeout) as response:
+            response.read()
+            for header in response.headers.get_all("Set-Cookie") or []:
+                cookies.update({name: morsel.value for name, morsel in http.cookies.SimpleCookie(header).items()})
+        error = None
+    except urllib.error.HTTPError as e:
+        error = f"HTTP {e.code}"
+    except (urllib.error.URLError, OSError) as e:
+        error = type(e).__name__
+    return time.perf_counter() - start, error
+
+
+def replay(url, sessions, concurrency=8, delay=0.0, speed=0.0, timeout=60.0):
+    """
+    Replays the sessions against the running searcher (concurrency defines the number of sessions replayed at once).
+
+    Args:
+        url (str): The URL of the searcher.
+        sessions (list): The sessions reconstructed from logs.
+        concurrency (int): The number of concurrently replayed sessions.
+        delay (float): The pause (in seconds) between actions of one session.
+        speed (float): The speed of replay of recorded times (e.g. 2 is twice faster, 0 means that delay is used).
+        timeout (float): The timeout (in seconds) of one request.
+
+    Returns:
+        dict: The number of requests, error rate, errors by type, throughput and percentiles of latency
+            (in milliseconds).
+    """
+    url = url if url.endswith("/") else url + "/"
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = [result for session_results in executor.map(
+            lambda session: replay_session(url, session, delay, speed, timeout), sessions)
+                   for result in session_results]
+    duration = time.perf_counter() - start
+
+    latencies = np.array([latency for latency, _ in results]) * 1000
+    errors = pd.Series([error for _, error in results if error is not None], dtype=str)
+    return {
+        'sessions': len(sessions),
+        'requests': len(results),
+        'errors': int(len(errors)),
+        'error_rate': round(len(errors) / max(1, len(results)), 4),
+        'errors_by_type': errors.value_counts().to_dict(),
+        'throughput_rps': round(len(results) / duration, 2),
+        'latency_ms': {f"p{p}": round(float(np.percentile(latencies, p)), 2) for p in (50, 90, 95, 99)} |
+                      {'max': round(float(latencies.max()), 2)} if len(latencies) else {},
+    }
+
+
+if __name__ == "__main__":
+    # usage: python replay.py http://localhost:8000/ ../gasearcher/static/data/log.csv --concurrency 16
+    parser = argparse.ArgumentParser(description="Replays sessions from query logs against a running searcher.")
+    parser.add_argument("url", help="URL of the searcher")
+    parser.add_argument("logs", nargs="+", help="log files (log.csv, log_similarity.csv or log.jsonl)")
+    parser.add_argument("--concurrency", type=int, default=8, help="number of concurrently replayed sessions")
+    parser.add_argument("--delay", type=float, default=0.0, help="pause in seconds between actions of one session")
+    parser.add_argument("--speed", type=float, default=0.0,
+                        help="speed of replay of recorded times of JSON logs (0 = use --delay)")
+    parser.add_argument("--sessions", type=int, help="maximal number of replayed sessions")
+    parser.add_argument("--timeout", type=float, default=60.0, help="timeout of one request in seconds")
+    args = parser.parse_args()
+
+    replayed = load_sessions(args.logs)[:args.sessions]
+    print(json.dumps(replay(args.url, replayed, args.concurrency, args.delay, args.speed, args.timeout), indent=2))
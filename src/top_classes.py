@@ -1,23 +1,33 @@
 import os
+import sys
 
 import clip
+import numpy as np
 import torch
 
+# the packed format is shared with the searcher
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "gasearcher"))
+from gas.classes import class_matrix, write_class_matrix
+from gas.embeddings import read_packed
+
 # load the model
 device = "cuda" if torch.cuda.is_available() else "cpu"
 model, preprocess = clip.load('ViT-B/32', device)
 
 
-def classify_images(vectors_path, nounlist_path, result_file, top_k=10):
+def classify_images(vectors_path, nounlist_path, result_file, top_k=10, matrix_file=None):
     """
     Classifies images by comparing their features obtained from CLIP model to the features of each class
     (also obtained from the same CLIP model).
 
     Args:
-        vectors_path (str): The path to the directory containing the image features obtained from the CLIP model.
+        vectors_path (str): The path to the directory containing the image features obtained from the CLIP model
+            (or the path to the packed file with all features).
         nounlist_path (str): The path to the nounlist dataset features obtained from the CLIP model.
         result_file (str): The path to the file where the results will be stored.
         top_k (int): The number of top classes to return for each image.
+        matrix_file (str): The path to the binary file where the results will be also stored (loaded by the searcher
+            without parsing of the CSV file).
     """
     # load nounlist (text dataset) features
     text_features = torch.load(nounlist_path)
@@ -26,14 +36,37 @@ def classify_images(vectors_path, nounlist_path, result_file, top_k=10):
     with open(result_file, 'a') as f:
         f.write("id;top\n")
 
-    for fn in os.listdir(vectors_path):
-        filename = vectors_path + "/" + fn
-        # load image features get from clip
-        image_features = torch.load(filename)
-
+    ids, top = [], []
+    for name, image_features in load_vectors(vectors_path):
         # get top k classes for image
         similarity = (100.0 * image_features @ text_features.T)
         values, indices = similarity[0].topk(top_k)
 
         with open(result_file, 'a') as f:
-            f.write(fn[:-3] + ';' + str(list(indices.numpy())) + '\n')
+            f.write(name + ';' + str(list(indices.numpy())) + '\n')
+        ids.append(int(name))
+        top.append(indices.tolist())
+
+    if matrix_file:
+        write_class_matrix(matrix_file, class_matrix(ids, top))
+
+
+def load_vectors(vectors_path):
+    """
+    Iterates over image features saved in a directory (one .pt file per image) or in one packed file.
+
+    Args:
+        vectors_path (str): The path to the directory or to the packed file with image features.
+
+    Yields:
+        tuple: The name of image and its features (with shape 1 x dim).
+    """
+    if os.path.isfile(vectors_path):
+        vectors, ids = read_packed(vectors_path)
+        for image_id, vector in zip(ids, vectors):
+            yield str(image_id).zfill(5), torch.from_numpy(np.array(vector, dtype=np.float32)).unsqueeze(0)
+        return
+
+    for fn in os.listdir(vectors_path):
+        # load image features get from clip
+        yield fn[:-3], torch.load(vectors_path + "/" + fn)